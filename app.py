@@ -1,61 +1,193 @@
 from random import randint
-from flask import Flask, render_template, redirect, url_for, request
+from flask import Flask, render_template, redirect, url_for, request, g, Response, stream_with_context, \
+    before_render_template, template_rendered
+from markupsafe import escape
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, current_user, logout_user, login_required
-import smartsheet
+import click
 import requests
 import config
+import os
 import re
-from datetime import datetime
-from utils import hash_pass, verify_pass
+import hmac
+import hashlib
+import io
+import csv
+import json
+import time
+import atexit
+import threading
+from itertools import chain, islice
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from utils import hash_pass, verify_pass, needs_rehash, configure_password_hashing, LRUCache, Lazy
+from workflow import WorkflowSync, CELL_FIELDS
+from change_feed import ChangeFeed, RowWatcher
+from sheet_writer import RowWriteQueue
+from metrics import Registry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from rate_limit import RateLimiter, LimitedClient, GATE_WRITE, USER_READ, BACKGROUND_SYNC
+from carrier_client import CarrierClient
+from carrier_outbox import OutboxWorker
+from audit_log import AuditLogWriter
+from sqlite_profile import apply_sqlite_profile, create_missing_indexes
+from archive import MoveArchiver
+from log_partitions import LogPartitions
 
 SMARTSHEET_TOKEN = config.smartsheet_token
 
-ss_client = smartsheet.Smartsheet(SMARTSHEET_TOKEN)
+
+def new_ss_client():
+    import smartsheet  # the SDK takes a while to import, CLI commands and forked workers that don't use it skip it
+    # no retries inside the SDK, 429s come back to ss_rate_limiter which holds every call back and retries
+    return smartsheet.Smartsheet(SMARTSHEET_TOKEN, max_retry_time=0)
+
+
+ss_client = Lazy(new_ss_client)
+
+metrics = Registry()
+ss_request_seconds = metrics.histogram('smartsheet_request_duration_seconds',
+                                       'SS API calls by SDK method, waits for a rate limit token excluded',
+                                       labels=('operation', 'outcome'))
+carrier_request_seconds = metrics.histogram('carrier_request_duration_seconds',
+                                            'Carrier API calls by carrier and endpoint',
+                                            labels=('scac', 'endpoint', 'status'))
+db_commits = metrics.counter('db_commits_total', 'Committed transactions by database bind', labels=('bind',))
+template_render_seconds = metrics.histogram('template_render_duration_seconds', 'Template rendering',
+                                            labels=('template',))
+http_request_seconds = metrics.histogram('http_request_duration_seconds',
+                                         'Requests until the response is returned, streamed bodies excluded',
+                                         labels=('endpoint', 'method', 'status'))
+
+# every SS call of the process goes through it, gate writes first, then reads of request threads, then syncs.
+# ss_rate_limit and ss_rate_burst are for the whole account, shared by the worker processes:
+# each one gets its part, worker_processes defaults to gunicorn's WEB_CONCURRENCY
+worker_processes = max(1, getattr(config, 'worker_processes', int(os.environ.get('WEB_CONCURRENCY', 1))))
+ss_rate_limiter = RateLimiter(rate=getattr(config, 'ss_rate_limit', 4.5) / worker_processes,
+                              burst=max(1, getattr(config, 'ss_rate_burst', 10) // worker_processes),
+                              max_backoff=getattr(config, 'ss_rate_max_backoff', 60),
+                              on_call=lambda operation, outcome, seconds: ss_request_seconds.observe(seconds, operation,
+                                                                                                     outcome))
 
 carriers = config.carriers
 driver_id_to_scac = config.driver_id_to_scac
 locations = config.locations
 
-OPEN_MOVES_LOG_SHEETS = config.open_move_log_sheet_id
+# {sheet_id: column ids in the order of CELL_FIELDS}, the open move log can be split across sheets,
+# e.g. one per location or customer
+OPEN_MOVES_LOG_SHEETS = getattr(config, 'open_move_log_sheets', None) or {
+    config.open_move_log_sheet_id: config.col_id_filter}
+
+for sheet_id, col_id_filter in OPEN_MOVES_LOG_SHEETS.items():
+    if len(col_id_filter) != len(CELL_FIELDS):
+        raise ValueError(f'Open move log {sheet_id} has {len(col_id_filter)} columns configured, '
+                         f'{len(CELL_FIELDS)} expected: {", ".join(CELL_FIELDS)}')
+
+sheet_col_names = {sheet_id: dict(zip(col_id_filter, CELL_FIELDS))  # {sheet_id: {column_id: WorkflowMove field}}
+                   for sheet_id, col_id_filter in OPEN_MOVES_LOG_SHEETS.items()}
+
+# {sheet_id: {WorkflowMove field: column_id}} of the cells update_move_id_row writes, the columns read by default
+sheet_write_columns = {sheet_id: {field: column_id for column_id, field in col_names.items()}
+                       for sheet_id, col_names in sheet_col_names.items()}
+if getattr(config, 'open_move_log_sheet_id', None) in sheet_write_columns:
+    sheet_write_columns[config.open_move_log_sheet_id].update({
+        'scac': 4303620233553796,  # 'Shuttle Provider SCAC'
+        'driver_id': 222233071249284,  # 'Driver Name (Last, First)'
+        'truck_number': 8807219860924292,  # 'Truck Number'
+        'ss_status': 4725832698619780,  # 'Status'
+        'comments': 2474032884934532,  # 'Comments'
+    })
+for sheet_id, write_columns in getattr(config, 'open_move_log_write_columns', {}).items():
+    if sheet_id not in sheet_write_columns:
+        raise ValueError(f'config.open_move_log_write_columns has columns for sheet {sheet_id}, '
+                         f'which is not an open move log sheet: {", ".join(map(str, OPEN_MOVES_LOG_SHEETS))}')
+    unknown_fields = set(write_columns) - set(CELL_FIELDS)
+    if unknown_fields:
+        raise ValueError(f'config.open_move_log_write_columns of sheet {sheet_id} has unknown fields '
+                         f'{", ".join(sorted(unknown_fields))}, expected some of: {", ".join(CELL_FIELDS)}')
+    sheet_write_columns[sheet_id].update(write_columns)
 
-open_moves_log_version = ''
-open_moves_log = []
+driver_page_sessions = {}  # {session_id: timestamp}
 
-col_names = {}
-col_id_filter = config.col_id_filter
+configure_password_hashing(iterations=getattr(config, 'password_iterations', 100000),
+                           workers=getattr(config, 'password_hash_workers', 2),
+                           max_pending=getattr(config, 'password_hash_max_pending', 8))
 
-driver_page_sessions = {}  # {session_id: timestamp}
+io_pool = ThreadPoolExecutor(max_workers=getattr(config, 'io_pool_size', 16), thread_name_prefix='io',
+                             initializer=ss_rate_limiter.set_thread_priority, initargs=(USER_READ,))
 
+ss_round_trips_saved = 0  # get_row calls answered from the workflow snapshot instead
 
-class WorkflowMove:
-    def __init__(self, move_id, row_id, container_number, load_status, priority, customer, origin, destination, scac,
-                 truck_number, driver_id, ss_status, comments):
-        self.move_id = move_id
-        self.row_id = row_id
-        self.container_number = container_number
-        self.load_status = load_status
-        self.priority = priority
-        self.customer = customer
-        self.origin = origin
-        self.destination = destination
-        self.scac = scac
-        self.truck_number = truck_number
-        self.driver_id = driver_id
-        self.ss_status = ss_status
-        self.comments = comments
+change_feed = ChangeFeed(history=getattr(config, 'change_feed_history', 1000),
+                         heartbeat=getattr(config, 'change_feed_heartbeat', 15))
 
-    def __repr__(self):
-        return self.move_id
 
-    def add_scac(self, scac):
-        if scac is None:
-            self.move_id += scac
-            self.scac = scac
+def change_keys(*moves):
+    """Customers and locations (origin or destination) concerned by a change, moves may be None."""
+    moves = [move for move in moves if move is not None]
+    customers = {move['customer'] for move in moves}
+    locations = {move['origin'] for move in moves} | {move['destination'] for move in moves}
+    return customers, locations
+
+
+def compact_change(key, previous, current):
+    """Only the fields that changed, all of them for a new move, {key..., 'removed': True} for a removed one."""
+    if current is None:
+        return {**key, 'removed': True}
+    return {**key, **{field: value for field, value in current.items()
+                      if previous is None or previous.get(field) != value}}
+
+
+def publish_workflow_changes(previous_snapshot, snapshot):
+    if not previous_snapshot.versions:
+        return  # first sync of the process, nothing changed for the clients
+
+    changes = []
+    for previous_move, move in snapshot.changes(previous_snapshot):
+        previous = previous_move and dict(zip(CELL_FIELDS, (getattr(previous_move, field) for field in CELL_FIELDS)))
+        current = move and dict(zip(CELL_FIELDS, (getattr(move, field) for field in CELL_FIELDS)))
+        key = {'move_id': (move or previous_move).move_id}
+        changes.append((*change_keys(previous, current), compact_change(key, previous, current)))
+
+    change_feed.publish('workflow', changes)
 
 
-workflow = {}  # format as following:
-# {'Unique Move ID': WorkflowMove}
+def pending_move_fields(sheet_id):
+    """{row_id: {WorkflowMove field: value}} of the writes to a sheet still in its write queue."""
+    column_fields = {column_id: field for field, column_id in sheet_write_columns[sheet_id].items()}
+    return {row_id: {column_fields[column_id]: value if value != '' else None
+                     for column_id, value in cells.items() if column_id in column_fields}
+            for row_id, cells in row_write_queues[sheet_id].pending().items()}
+
+
+workflow_sync = WorkflowSync(LimitedClient(ss_client, ss_rate_limiter, BACKGROUND_SYNC),
+                             sheet_col_names,
+                             interval=getattr(config, 'workflow_sync_interval', 15),
+                             max_staleness=getattr(config, 'workflow_max_staleness', 60),
+                             incremental=getattr(config, 'workflow_incremental_sync', True),
+                             on_publish=publish_workflow_changes,
+                             webhook_active=bool(getattr(config, 'smartsheet_webhook_enabled', False)),
+                             fallback_interval=getattr(config, 'workflow_fallback_interval', 300),
+                             pending_fields=pending_move_fields)
+
+row_write_queues = {}  # {sheet_id: RowWriteQueue}
+for sheet_id in OPEN_MOVES_LOG_SHEETS:
+    row_write_queues[sheet_id] = RowWriteQueue(LimitedClient(ss_client, ss_rate_limiter, GATE_WRITE),
+                                               sheet_id,
+                                               flush_interval=getattr(config, 'ss_write_flush_interval', 1),
+                                               batch_size=getattr(config, 'ss_write_batch_size', 100),
+                                               on_flush=lambda: workflow_sync.refresh(wait=False))
+    atexit.register(row_write_queues[sheet_id].flush)
+
+carrier_client = CarrierClient(carriers,
+                               timeout=getattr(config, 'carrier_timeout', (3.05, 10)),
+                               pool_sizes=getattr(config, 'carrier_pool_sizes', None),
+                               driver_ttl=getattr(config, 'carrier_driver_ttl', 10),
+                               negative_driver_ttl=getattr(config, 'carrier_negative_driver_ttl', 30),
+                               on_request=lambda scac, endpoint, status, seconds: carrier_request_seconds.observe(
+                                   seconds, scac, endpoint, status))
 
 app = Flask(__name__,
             static_folder='static', )
@@ -130,7 +262,7 @@ class InviteCodes(db.Model):
 
     id = db.Column(db.Integer, primary_key=True, unique=True, autoincrement=True)
     email = db.Column(db.String(256), unique=True)
-    invite_code = db.Column(db.String(7))
+    invite_code = db.Column(db.String(7), index=True)
     user_type = db.Column(db.String(16))
     created_at = db.Column(db.DateTime, default=db.func.localtimestamp())
     modified_at = db.Column(db.DateTime, default=db.func.localtimestamp(), onupdate=db.func.localtimestamp())
@@ -143,6 +275,7 @@ class InviteCodes(db.Model):
 
 class OpenMoves(db.Model):
     __tablename__ = 'open_moves'
+    __table_args__ = (db.Index('ix_open_moves_driver_id_move_id', 'driver_id', 'move_id'),)
     """
 
     :param move_id: nullable
@@ -226,6 +359,8 @@ class OpenMoves(db.Model):
 class CompletedMoves(db.Model):
     __bind_key__ = 'completed_moves'
     __tablename__ = 'completed_moves'
+    __table_args__ = (db.Index('ix_completed_moves_move_id_driver_id_created_at', 'move_id', 'driver_id', 'created_at',
+                               unique=True),)
     """
 
     :param move_id: nullable
@@ -333,7 +468,7 @@ class MoveLog(db.Model):
     by_user = db.Column(db.String(256), nullable=True)
     driver_id = db.Column(db.String(16), nullable=True)
     scac = db.Column(db.String(8), nullable=True)
-    move_id = db.Column(db.String(24), nullable=True)
+    move_id = db.Column(db.String(24), nullable=True, index=True)
     detailed_info = db.Column(db.String(2048), nullable=True)
     created_at = db.Column(db.DateTime, default=db.func.localtimestamp())
     modified_at = db.Column(db.DateTime, default=db.func.localtimestamp(), onupdate=db.func.localtimestamp())
@@ -347,12 +482,171 @@ class MoveLog(db.Model):
         self.detailed_info = detailed_info
 
 
-with app.app_context():
-    db.create_all()
+class CarrierOutbox(db.Model):
+    __tablename__ = 'carrier_outbox'
+    __table_args__ = (db.Index('ix_carrier_outbox_status_driver_id', 'status', 'driver_id'),)
+
+    """
+    Carrier notifications waiting to be delivered by the outbox worker, delivered ones are deleted.
+
+    :param path: carrier endpoint, relative to its base url
+    :param payload: json body
+    :param status: 'PENDING'/'FAILED'
+    """
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    scac = db.Column(db.String(8))
+    driver_id = db.Column(db.String(16), nullable=False)
+    path = db.Column(db.String(64))
+    payload = db.Column(db.String(2048))
+    status = db.Column(db.String(8), default='PENDING')
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=True)
+    locked_by = db.Column(db.String(32), nullable=True)
+    locked_until = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.String(256), nullable=True)
+    created_at = db.Column(db.DateTime, default=db.func.localtimestamp())
+    modified_at = db.Column(db.DateTime, default=db.func.localtimestamp(), onupdate=db.func.localtimestamp())
+
+    def __init__(self, scac, driver_id, path, payload):
+        self.scac = scac
+        self.driver_id = driver_id
+        self.path = path
+        self.payload = payload
+        self.status = 'PENDING'
+        self.attempts = 0
+
+
+class ArchiveState(db.Model):
+    __tablename__ = 'archive_state'
+
+    """
+    Single row shared by the move archivers of every process.
+
+    :param high_water_mark: id of the last open move archived by an unfinished run, 0 once a run is done
+    :param locked_by: token of the archiver running, None if none is
+    :param locked_until: when its lease expires
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    high_water_mark = db.Column(db.Integer, default=0)
+    locked_by = db.Column(db.String(32), nullable=True)
+    locked_until = db.Column(db.DateTime, nullable=True)
+
+
+class LogRotationState(db.Model):
+    __tablename__ = 'log_rotation_state'
+
+    """
+    Single row shared by the log rotations of every process.
+
+    :param locked_by: token of the rotation running, None if none is
+    :param locked_until: when its lease expires
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    locked_by = db.Column(db.String(32), nullable=True)
+    locked_until = db.Column(db.DateTime, nullable=True)
+
+
+class WebhookCallback(db.Model):
+    __tablename__ = 'webhook_callback'
+
+    """
+    SS webhook callbacks, saved so the workflow sync of every worker gets them, not only the one SS posted to.
+    Deleted after an hour.
+
+    :param row_ids: json list of the rows to sync
+    :param webhook_status: newWebhookStatus of a status callback, None for a change callback
+    """
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    sheet_id = db.Column(db.BigInteger, nullable=True)
+    row_ids = db.Column(db.Text, nullable=True)
+    sheet_changed = db.Column(db.Boolean, default=False)
+    webhook_status = db.Column(db.String(16), nullable=True)
+    created_at = db.Column(db.DateTime, default=db.func.localtimestamp())
+    modified_at = db.Column(db.DateTime, default=db.func.localtimestamp(), onupdate=db.func.localtimestamp(),
+                            index=True)
+
+    def __init__(self, sheet_id=None, row_ids=(), sheet_changed=False, webhook_status=None):
+        self.sheet_id = sheet_id
+        self.row_ids = json.dumps(sorted(row_ids))
+        self.sheet_changed = sheet_changed
+        self.webhook_status = webhook_status
+
+
+outbox_worker = OutboxWorker(app, db, CarrierOutbox, carrier_client,
+                             max_attempts=getattr(config, 'carrier_outbox_max_attempts', 10))
+
+audit_log = AuditLogWriter(app, db,
+                           mode=getattr(config, 'audit_log_mode', 'batched'),
+                           batch_size=getattr(config, 'audit_log_batch_size', 100),
+                           flush_interval=getattr(config, 'audit_log_flush_interval', 1))
+atexit.register(audit_log.flush)
+
+log_partitions = LogPartitions(app, db, [SiteLog.__table__, MoveLog.__table__], LogRotationState,
+                               directory=os.path.join(app.instance_path, 'log_partitions'),
+                               retention_months=getattr(config, 'log_retention_months', 12))
+
+move_archiver = MoveArchiver(app, db, OpenMoves, CompletedMoves, ArchiveState,
+                             interval=getattr(config, 'archive_interval', 600),
+                             batch_size=getattr(config, 'archive_batch_size', 100),
+                             pause=getattr(config, 'archive_pause', 0.5),
+                             issue_after=timedelta(hours=getattr(config, 'archive_issue_after_hours', 72)))
 
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
+_setup_lock = threading.Lock()
+_setup_done = False
+
+
+def count_commit(bind, connection):
+    db_commits.inc(bind)
+
+
+def setup_app():
+    """
+    Set up what importing the app no longer does: SQLite pragmas, missing tables and indexes, the saved workflow snapshot.
+    Runs once, from create_app(), or else before the first request or CLI command that needs it.
+    """
+    global _setup_done
+
+    if _setup_done:
+        return
+
+    with _setup_lock:
+        if _setup_done:
+            return
+
+        with app.app_context():
+            apply_sqlite_profile(db, getattr(config, 'sqlite_pragmas', None))
+            db.create_all()
+            create_missing_indexes(db)
+
+            for bind, engine in db.engines.items():
+                event.listen(engine, 'commit', partial(count_commit, bind or 'default'))
+
+        workflow_sync.load()
+
+        with app.app_context():
+            # a preloading server forks right after, workers must not share the SQLite handles opened here
+            for engine in db.engines.values():
+                engine.dispose()
+
+        _setup_done = True
+
+
+def create_app():
+    """
+    App factory, for WSGI servers ('gunicorn "app:create_app()"') and 'flask --app app:create_app'.
+    Sets the app up before returning it, so with a preloading server it's done once before workers fork
+    and they start with the workflow snapshot already in memory.
+    """
+    setup_app()
+    return app
+
 
 def new_alt_id():
     while True:
@@ -374,9 +668,8 @@ def new_invite_token():
 
 
 def new_site_log(action_type, by_user, affected_user=None, detailed_info=None):
-    new_log = SiteLog(action_type, by_user, affected_user, detailed_info)
-    db.session.add(new_log)
-    db.session.commit()
+    audit_log.add(SiteLog, action_type=action_type, by_user=by_user, affected_user=affected_user,
+                  detailed_info=detailed_info)
 
 
 def new_move_log(action_type, by_user, driver_id, scac, move_id, detailed_info=None):
@@ -388,58 +681,175 @@ def new_move_log(action_type, by_user, driver_id, scac, move_id, detailed_info=N
     :param move_id: Move ID action is taken on
     :param detailed_info: extra info if applicable
     """
-    new_log = MoveLog(action_type, by_user, driver_id, scac, move_id, detailed_info)
-    db.session.add(new_log)
-    db.session.commit()
+    audit_log.add(MoveLog, action_type=action_type, by_user=by_user, driver_id=driver_id, scac=scac, move_id=move_id,
+                  detailed_info=detailed_info)
 
 
-@login_manager.user_loader
-def load_user(user_id):
-    user = User.query.filter_by(alternative_id=user_id).first()
-    if user is None or user.is_suspended:
-        return None
-    else:
-        return user
+@app.cli.command('rotate-logs')
+def rotate_logs():
+    """Move logs older than the current month to their monthly partition, while the app keeps running."""
+    setup_app()
+    if log_partitions.rotate() is None:
+        click.echo('Logs are being rotated by another process')
+
 
+@app.cli.command('init-db')
+def init_db():
+    """Create missing tables and indexes."""
+    setup_app()
 
-def update_workflow_list(forced=False):
+
+@app.cli.command('register-webhook')
+@click.argument('callback_url')
+def register_webhook(callback_url):
+    """
+    Create and enable a SS webhook on every open move log sheet posting to CALLBACK_URL (.../smartsheet/webhook),
+    SS checks the url with a challenge before enabling it. Prints the shared secret to put in config.
     """
-    Check if workflow was updated.
-    If so then sync current workflow variable with SS open move log.
+    import smartsheet
+
+    for sheet_id in OPEN_MOVES_LOG_SHEETS:
+        webhook = ss_client.Webhooks.create_webhook(smartsheet.models.Webhook({
+            'name': f'Gate workflow sync {sheet_id}',
+            'callbackUrl': callback_url,
+            'scope': 'sheet',
+            'scopeObjectId': sheet_id,
+            'events': ['*.*'],
+            'version': 1})).result
+
+        enabled = ss_client.Webhooks.update_webhook(webhook.id, smartsheet.models.Webhook({'enabled': True})).result
+        click.echo(f'Webhook {webhook.id} on sheet {sheet_id} is {enabled.status}')
+        click.echo(f'smartsheet_webhook_secret = {webhook.shared_secret!r}')
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started_at = time.perf_counter()
+
+
+@app.before_request
+def start_background_workers():
+    setup_app()
+    ss_rate_limiter.set_thread_priority(USER_READ)  # inline syncs of request threads go before background ones
+    outbox_worker.start()
+    move_archiver.start()
+    log_partitions.start()
+    webhook_callbacks_watcher.start()
+
+
+@app.teardown_request
+def reset_ss_priority(error=None):
+    ss_rate_limiter.set_thread_priority(None)
+
+
+@app.after_request
+def observe_request(response):
+    started_at = g.get('request_started_at')
+    if started_at is not None:
+        http_request_seconds.observe(time.perf_counter() - started_at, request.endpoint or 'none', request.method,
+                                     response.status_code)
+    return response
+
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    g.setdefault('template_started_at', {})[template.name] = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def observe_template(sender, template, context, **extra):
+    started_at = g.get('template_started_at', {}).pop(template.name, None)
+    if started_at is not None:
+        template_render_seconds.observe(time.perf_counter() - started_at, template.name)
+
+
+@app.after_request
+def add_server_timing(response):
+    timings = g.get('server_timing')
+    if timings:
+        response.headers['Server-Timing'] = ', '.join(f'{name};dur={elapsed * 1000:.1f}'
+                                                      for name, elapsed in timings.items())
+    return response
+
+
+def timed(function, *args):
+    """Call function, returns its result and how many seconds it took."""
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def stage(name, timed_result):
+    """Keep the duration of a timed() call for the Server-Timing header, returns its result."""
+    result, elapsed = timed_result
+    g.setdefault('server_timing', {})[name] = elapsed
+    return result
+
+
+# {alternative_id: User column values}, rebuilt into a User of the request's session on every hit,
+# entries are dropped when their user is updated or deleted by this process, and checked on every hit for the others
+user_cache = LRUCache(max_size=getattr(config, 'user_cache_size', 256), ttl=getattr(config, 'user_cache_ttl', 30))
+USER_COLUMNS = [column.name for column in User.__table__.columns]
+# compared on every hit: what access and handlers depend on, modified_at for the rest (password...)
+USER_CHECKED_COLUMNS = ('id', 'type', 'location', 'scac', 'is_suspended', 'email', 'modified_at')
 
-    :param forced: True to force sync of current workflow
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, target):
+    user_cache.pop(str(target.alternative_id))
+    for old_alternative_id in inspect(target).attrs.alternative_id.history.deleted:
+        user_cache.pop(str(old_alternative_id))
+
+
+def cached_user_values(user_id):
+    """
+    Cached columns of a user, None if not cached or changed by another process since.
+    The cache is only invalidated by the process making a change, so a hit is checked against the columns
+    that can change with a query on the alternative_id index: still a round trip, but the password hash
+    and the rest of the row aren't loaded, and the User is rebuilt without going through the ORM loading.
     """
-    new_version = ss_client.Sheets.get_sheet_version(OPEN_MOVES_LOG_SHEETS).__str__()
+    values = user_cache.get(user_id)
+    if values is None:
+        return None
 
-    global open_moves_log_version
-    if not forced and open_moves_log_version == new_version:
-        return
+    current = (db.session.query(*[getattr(User, column) for column in USER_CHECKED_COLUMNS])
+               .filter_by(alternative_id=values['alternative_id']).first())
+    if current is None or tuple(current) != tuple(values[column] for column in USER_CHECKED_COLUMNS):
+        user_cache.pop(user_id)
+        return None
 
-    open_moves_log_version = new_version
+    return values
 
-    global open_moves_log
-    open_moves_log = ss_client.Sheets.get_sheet(OPEN_MOVES_LOG_SHEETS, column_ids=col_id_filter)
 
-    global workflow
-    workflow = {}
+@login_manager.user_loader
+def load_user(user_id):
+    values = cached_user_values(user_id)
+    if values is None:
+        user = User.query.filter_by(alternative_id=user_id).first()
+        if user is None:
+            return None
+        user_cache.put(user_id, {column: getattr(user, column) for column in USER_COLUMNS})
 
-    for i in open_moves_log.rows:
-        workflow.update({i.cells[0].display_value: WorkflowMove(i.cells[0].display_value,
-                                                                i.id,
-                                                                i.cells[1].display_value,
-                                                                i.cells[2].display_value,
-                                                                i.cells[3].display_value,
-                                                                i.cells[4].display_value,
-                                                                i.cells[5].display_value,
-                                                                i.cells[6].display_value,
-                                                                i.cells[7].display_value,
-                                                                i.cells[8].display_value,
-                                                                i.cells[9].display_value,
-                                                                i.cells[10].display_value,
-                                                                i.cells[11].display_value)})
+    else:
+        # attached without a query, so handlers can update current_user like a loaded user
+        user = User(values['alternative_id'], values['email'], values['password'], values['type'],
+                    values['location'], values['is_suspended'])
+        for column, value in values.items():
+            setattr(user, column, value)
+        make_transient_to_detached(user)
+        db.session.add(user)
+
+    if user.is_suspended:
+        return None
+    else:
+        return user
 
 
-update_workflow_list(forced=True)
+# no download at boot: setup_app() starts from the last saved snapshot, the background thread reconciles it with
+# the sheet, without one the first reader syncs inline
+workflow_sync.snapshot_path = getattr(config, 'workflow_snapshot_path',
+                                      os.path.join(app.instance_path, 'workflow_snapshot.pickle'))
 
 
 @app.route('/')
@@ -518,6 +928,10 @@ def login():
                                message="User doesn't exist")
 
     if verify_pass(provided_password, user.password):
+        if needs_rehash(user.password):
+            user.password = hash_pass(provided_password)
+            db.session.commit()
+
         login_user(user)
         new_site_log('LOG_IN', user.email)
         return redirect(url_for('index'), 302)
@@ -538,7 +952,7 @@ def logout():
 @app.route('/invite_codes', methods=['GET', 'POST'])
 @login_required
 def invite_codes():
-    user = User.query.filter_by(id=int(current_user.get_real_id())).first()
+    user = current_user
 
     if user.type != 'supervisor':
         return redirect(url_for('index'), 302)
@@ -596,7 +1010,7 @@ def invite_codes():
 @app.route('/profile', methods=['POST', 'GET'])
 @login_required
 def profile():
-    user = User.query.filter_by(id=int(current_user.get_real_id())).first()
+    user = current_user
 
     if request.method == 'GET':
         return render_template('home/profile.html',
@@ -639,7 +1053,7 @@ def profile():
 @app.route('/users', methods=['GET', 'POST'])
 @login_required
 def users():
-    user = User.query.filter_by(id=int(current_user.get_real_id())).first()
+    user = current_user
 
     if user.type != 'supervisor':
         return redirect(url_for('index'), 302)
@@ -660,7 +1074,7 @@ def users():
 @app.route('/user_manager/<alternative_id>', methods=['GET', 'POST'])
 @login_required
 def user_manager(alternative_id):
-    user = User.query.filter_by(id=int(current_user.get_real_id())).first()
+    user = current_user
 
     # if user.type != 'supervisor':
     #    return redirect(url_for('users'), 302)
@@ -744,7 +1158,17 @@ def driver_w_shuttle_id(raw_shuttle_id):
     if not carriers.get(scac, False):
         return render_template('home/driver.html', message="Carrier not found")
 
-    r = requests.get(f'{carriers.get(scac)}get_driver/{shuttle_id}')
+    # carrier, SS and db don't depend on each other, the page waits for the slowest of them
+    # until the outbox delivered the driver's move changes, the carrier replies with moves about to change
+    driver_reply = io_pool.submit(timed, carrier_client.get_driver, scac, shuttle_id,
+                                  not outbox_worker.has_pending(shuttle_id))
+    workflow_snapshot = io_pool.submit(timed, workflow_sync.snapshot)
+    driver_moves = stage('db', timed(OpenMoves.query.filter_by(driver_id=shuttle_id).order_by(OpenMoves.id).all))
+
+    try:
+        r = stage('carrier', driver_reply.result())
+    except requests.RequestException:
+        return render_template('home/driver.html', message="Carrier is not responding, please try again")
 
     if r.status_code == 404:
         return render_template('home/driver.html', message="Driver not found")
@@ -759,7 +1183,7 @@ def driver_w_shuttle_id(raw_shuttle_id):
         # TODO: log the error
         return render_template('home/driver.html', message="Some strange error, please report this")
 
-    update_workflow_list()
+    workflow = stage('workflow', workflow_snapshot.result())
 
     r = r.json()
 
@@ -786,7 +1210,7 @@ def driver_w_shuttle_id(raw_shuttle_id):
     move_ids_opposite_direction = ['BOBTAIL']
     move_ids_opposite_direction_no_scac = []
 
-    current_move = OpenMoves.query.filter_by(driver_id=shuttle_id, move_id=current_move_id).first()
+    current_move = next((move for move in driver_moves if move.move_id == current_move_id), None)
     if current_move is not None:
         current_container_number = current_move.container_number
         current_container_origin = current_move.origin
@@ -795,21 +1219,14 @@ def driver_w_shuttle_id(raw_shuttle_id):
         if move is None and current_move_id != 'BOBTAIL':
             current_move_msg = 'Move not found in open move log'
 
-    for i in workflow.values():
-        if i.customer == assigned_customer and not i.driver_id:
-            if not current_move_id and i.origin == authorised_from_location:
-
-                if i.scac == scac:
-                    move_ids_current_direction.append(i.move_id)
-                elif i.scac is None:
-                    move_ids_current_direction_no_scac.append(i.move_id)
+    if not current_move_id:
+        move_ids_current_direction.extend(workflow.candidates(assigned_customer, authorised_from_location, scac))
+        move_ids_current_direction_no_scac.extend(workflow.candidates(assigned_customer, authorised_from_location, None))
 
-            elif not opposite_direction_move_id and i.origin == current_container_destination:
-
-                if i.scac == scac:
-                    move_ids_opposite_direction.append(i.move_id)
-                elif i.scac is None:
-                    move_ids_opposite_direction_no_scac.append(i.move_id)
+    # moves leaving from the authorised location are only offered for the current direction
+    if not opposite_direction_move_id and (current_move_id or current_container_destination != authorised_from_location):
+        move_ids_opposite_direction.extend(workflow.candidates(assigned_customer, current_container_destination, scac))
+        move_ids_opposite_direction_no_scac.extend(workflow.candidates(assigned_customer, current_container_destination, None))
 
     move_ids_current_direction.extend(move_ids_current_direction_no_scac)
     move_ids_opposite_direction.extend(move_ids_opposite_direction_no_scac)
@@ -875,7 +1292,15 @@ def driver():
         if hasattr(scac, '__iter__') and not isinstance(scac, str):
             scac = scac[0]
 
-    r = requests.get(f'{carriers.get(scac)}get_driver/{shuttle_id}')
+    # until the outbox delivered the driver's move changes, the carrier replies with moves about to change
+    driver_reply = io_pool.submit(timed, carrier_client.get_driver, scac, shuttle_id,
+                                  not outbox_worker.has_pending(shuttle_id))
+    workflow_snapshot = io_pool.submit(timed, workflow_sync.snapshot)
+
+    try:
+        r = stage('carrier', driver_reply.result())
+    except requests.RequestException:
+        return render_template('home/driver.html', message="Carrier is not responding, please try again")
 
     if r.status_code == 404:
         return render_template('home/driver.html', message="Driver not found")
@@ -892,7 +1317,7 @@ def driver():
 
     wc_admin = True if current_user.type == 'supervisor' or current_user.type == 'wc_admin' else False
 
-    update_workflow_list()
+    workflow = stage('workflow', workflow_snapshot.result())
 
     r = r.json()
     truck_number = r.get('truck_number')
@@ -920,6 +1345,7 @@ def driver():
 
         if new_current_move_id == 'STANDBY':
             assign_current_move(scac, shuttle_id, 'STANDBY')
+            db.session.commit()
 
         elif new_current_move_id == 'BOBTAIL':
             return redirect(url_for('driver_w_shuttle_id', raw_shuttle_id=shuttle_id, current_pending_bobtail='True'))
@@ -931,7 +1357,6 @@ def driver():
                                new_driver_id=shuttle_id,
                                new_truck=truck_number,
                                new_status='Open')
-            new_current_move.add_scac(scac)
 
             move = OpenMoves(new_current_move.move_id,
                              new_current_move.row_id,
@@ -949,13 +1374,12 @@ def driver():
                              truck_license_plate)
 
             db.session.add(move)
-            db.session.commit()
-
             assign_current_move(scac, shuttle_id,
                                 move_id=new_current_move.move_id,
                                 origin=new_current_move.origin,
                                 destination=new_current_move.destination,
                                 container_number=new_current_move.container_number)
+            db.session.commit()
 
             new_move_log('ASSIGN', current_user.email, shuttle_id, scac, new_current_move_id)
 
@@ -990,7 +1414,6 @@ def driver():
                                new_driver_id=shuttle_id,
                                new_truck=truck_number,
                                new_status='Open')
-            new_next_move.add_scac(scac)
 
             move = OpenMoves(new_next_move.move_id,
                              new_next_move.row_id,
@@ -1008,9 +1431,8 @@ def driver():
                              truck_license_plate)
 
             db.session.add(move)
-            db.session.commit()
-
             assign_next_move(scac, shuttle_id, new_next_move.move_id)
+            db.session.commit()
             new_move_log('ASSIGN', current_user.email, shuttle_id, scac, opposite_direction_move_id, 'IS_NEXT')
 
         db.session.commit()
@@ -1042,13 +1464,12 @@ def driver():
                              truck_license_plate)
 
             db.session.add(move)
-            db.session.commit()
-
             assign_current_move(scac, shuttle_id,
                                 move_id='BOBTAIL',
                                 origin=current_user.location,
                                 destination=confirm_current_bobtail_destination,
                                 container_number=None)
+            db.session.commit()
             new_move_log('ASSIGN', current_user.email, shuttle_id, scac, opposite_direction_move_id)
 
         return redirect(url_for('driver_w_shuttle_id', raw_shuttle_id=shuttle_id))
@@ -1081,9 +1502,8 @@ def driver():
                              truck_license_plate)
 
             db.session.add(move)
-            db.session.commit()
-
             assign_next_move(scac, shuttle_id, move_id='BOBTAIL')
+            db.session.commit()
             new_move_log('ASSIGN', current_user.email, shuttle_id, scac, opposite_direction_move_id, 'IS_NEXT')
 
         elif confirm_next_bobtail_destination == 'CANCEL_BOBTAIL':
@@ -1152,7 +1572,7 @@ def driver():
                                new_status='Completed',
                                new_update='Forced to completed.')
             update_move_status(scac, shuttle_id, 'FORCE_TO_COMPLETED')
-            # TODO: MOVE TO COMPLETED MOVE LOG
+            # moved to the completed move log by move_archiver
             new_move_log('COMPLETED', current_user.email, shuttle_id, scac, current_move_id)
 
             if opposite_direction_move_id:
@@ -1171,9 +1591,8 @@ def driver():
 @app.route('/moves', methods=['GET'])
 @login_required
 def moves():
-    update_workflow_list()
     move_list = []
-    for i in workflow.values():
+    for i in workflow_sync.snapshot().values():
         move_list.append(i)
     return render_template('home/moves.html', moves=move_list)
 
@@ -1181,8 +1600,7 @@ def moves():
 @app.route('/moves/<move_ID>', methods=['GET', 'POST'])
 @login_required
 def single_move_id(move_ID):
-    update_workflow_list()
-    move = workflow.get(move_ID, None)
+    move = workflow_sync.snapshot().get(move_ID, None)
     if move:
         scac = move[8]
         driver_id = move[10]
@@ -1203,7 +1621,7 @@ def single_move_id(move_ID):
 
 @app.route('/api/get_move/<move_id>', methods=['GET'])
 def get_move(move_id):
-    move = workflow.get(move_id, False)
+    move = workflow_sync.snapshot().get(move_id, False)
     reply = {}
     if move:
         reply = {
@@ -1221,44 +1639,171 @@ def get_move(move_id):
     # TODO: REDO TO REPLY TO BOTS REQUESTS
 
 
+@app.route('/api/ss_rate_limit', methods=['GET'])
+@login_required
+def ss_rate_limit():
+    """Calls waiting for a SS rate limit token by priority class, and how long they waited so far."""
+    return {
+        'queue_depth': ss_rate_limiter.queue_depth(),
+        'wait_seconds': ss_rate_limiter.wait_seconds,
+        'max_wait_seconds': ss_rate_limiter.max_wait_seconds,
+        'calls': ss_rate_limiter.calls,
+        'rate_limited': ss_rate_limiter.rate_limited,
+    }
+
+
+LOG_PAGE_SIZE = 500
+LOG_MAX_PAGE_SIZE = 5000
+
+
+def log_page(model, filter_names):
+    """
+    Page of a log table, filtered by request args.
+    Reads the monthly partitions overlapping the time range first, then the current month.
+
+    ?<filter name>=value for each of filter_names, ?since= & ?until= ISO datetimes on created_at,
+    ?after_id= the last id of the previous page, ?limit= page size.
+    """
+    query = model.query
+    filters = {}
+
+    for name in filter_names:
+        value = request.args.get(name)
+        if value is not None:
+            query = query.filter(getattr(model, name) == value)
+            filters[name] = value
+
+    since = request.args.get('since', type=datetime.fromisoformat)
+    if since is not None:
+        query = query.filter(model.created_at >= since)
+
+    until = request.args.get('until', type=datetime.fromisoformat)
+    if until is not None:
+        query = query.filter(model.created_at < until)
+
+    after_id = request.args.get('after_id', type=int)
+    if after_id is not None:
+        query = query.filter(model.id > after_id)
+
+    limit = max(1, min(request.args.get('limit', LOG_PAGE_SIZE, type=int), LOG_MAX_PAGE_SIZE))
+
+    partitions = log_partitions.select(model.__table__, since, until, after_id, limit, **filters)
+    return islice(chain(partitions, query.order_by(model.id).limit(limit).yield_per(200)), limit), limit
+
+
+def stream_log(model, rows, limit, line):
+    """
+    Stream a log page row by row, as html lines or as json with ?format=json.
+
+    :param line: function to format a row as a line of text
+    """
+    as_json = request.args.get('format') == 'json'
+    columns = [column.name for column in model.__table__.columns]
+
+    def generate():
+        last_id, count = None, 0
+        yield '{"logs": [' if as_json else 'NONE<br>'
+
+        for i in rows:
+            if as_json:
+                yield (',' if count else '') + json.dumps({column: getattr(i, column) for column in columns}, default=str)
+            else:
+                yield str(escape(line(i))) + '<br>'
+            last_id, count = i.id, count + 1
+
+        next_page = None
+        if count == limit:
+            next_page = url_for(request.endpoint, **dict(request.args.to_dict(), after_id=last_id))
+
+        if as_json:
+            yield '], "next": ' + json.dumps(next_page) + '}'
+        elif next_page:
+            yield f'<a href="{escape(next_page)}">next</a>'
+
+    return Response(stream_with_context(generate()), mimetype='application/json' if as_json else 'text/html')
+
+
 @app.route('/site_log', methods=['GET'])
 @login_required
 def site_log():
-    log = SiteLog.query.all()
-    printed_log = 'NONE<br>'
-    for i in log:
-        printed_log += i.action_type + ' ' + str(i.by_user) + ' ' + str(i.affected_user) + ' ' + str(i.created_at) + ' ' + str(
-            i.modified_at) + ' ' + str(i.detailed_info) + '<br>'
-    return printed_log
+    rows, limit = log_page(SiteLog, ['action_type', 'by_user'])
+    return stream_log(SiteLog, rows, limit, lambda i: (
+        i.action_type + ' ' + str(i.by_user) + ' ' + str(i.affected_user) + ' ' + str(i.created_at) + ' ' + str(
+            i.modified_at) + ' ' + str(i.detailed_info)))
 
 
 @app.route('/move_log', methods=['GET'])
 @login_required
 def move_log():
-    log = MoveLog.query.all()
-    printed_log = 'NONE<br>'
-    for i in log:
-        printed_log += i.action_type + ' ' + str(i.by_user) + ' ' + str(i.driver_id) + ' ' + str(i.scac) + ' ' + str(
-            i.move_id) + ' ' + str(i.detailed_info) + ' ' + str(i.created_at) + '<br>'
-    return printed_log
+    rows, limit = log_page(MoveLog, ['action_type', 'by_user', 'driver_id', 'scac', 'move_id'])
+    return stream_log(MoveLog, rows, limit, lambda i: (
+        i.action_type + ' ' + str(i.by_user) + ' ' + str(i.driver_id) + ' ' + str(i.scac) + ' ' + str(
+            i.move_id) + ' ' + str(i.detailed_info) + ' ' + str(i.created_at)))
+
+
+OPEN_MOVES_COLUMNS = ('move_id', 'row_id', 'driver_id', 'container_number', 'origin', 'destination', 'status',
+                      'created_at', 'modified_at')
 
 
 @app.route('/open_moves', methods=['GET', 'POST'])
 @login_required
 def open_moves():
-    log = OpenMoves.query.all()
-    printed_log = 'NONE<br>'
-    for i in log:
-        printed_log += str(i.move_id) + ' '
-        printed_log += str(i.row_id) + ' '
-        printed_log += str(i.driver_id) + ' '
-        printed_log += str(i.container_number) + ' '
-        printed_log += str(i.origin) + ' '
-        printed_log += str(i.destination) + ' '
-        printed_log += str(i.status) + ' '
-        printed_log += str(i.created_at) + ' '
-        printed_log += str(i.modified_at) + '<br>'
-    return printed_log
+    """
+    Stream open moves as html lines, or as ?format=ndjson/csv.
+    Filtered by ?driver_id= ?scac= ?status= ?origin= ?destination=
+    """
+    query = db.session.query(*[getattr(OpenMoves, column) for column in OPEN_MOVES_COLUMNS])
+
+    for name in ('driver_id', 'scac', 'status', 'origin', 'destination'):
+        value = request.args.get(name)
+        if value is not None:
+            query = query.filter(getattr(OpenMoves, name) == value)
+
+    query = query.order_by(OpenMoves.id).yield_per(500)
+    output_format = request.args.get('format')
+
+    def generate_ndjson():
+        for row in query:
+            yield json.dumps(dict(zip(OPEN_MOVES_COLUMNS, row)), default=str) + '\n'
+
+    def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(OPEN_MOVES_COLUMNS)
+        yield buffer.getvalue()  # the header even without rows
+
+        buffer.seek(0)
+        buffer.truncate(0)
+        for count, row in enumerate(query, 1):
+            writer.writerow(row)
+            if count % 500 == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    def generate_html():
+        yield 'NONE<br>'
+        for row in query:
+            yield str(escape(' '.join(str(value) for value in row))) + '<br>'
+
+    if output_format == 'ndjson':
+        return Response(stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+
+    if output_format == 'csv':
+        return Response(stream_with_context(generate_csv()), mimetype='text/csv')
+
+    return Response(stream_with_context(generate_html()), mimetype='text/html')
+
+
+def notify_carrier(scac, path, data):
+    """
+    Queue a move update to a carrier in the outbox.
+    It is saved by the next db.session.commit(), together with the move change it announces,
+    and delivered by outbox_worker, which drops the cached get_driver reply once the carrier got it.
+    """
+    outbox_worker.add(scac, data['driver_id'], path, data)
 
 
 def assign_current_move(scac, driver_id, move_id, origin=None, destination=None, container_number=None):
@@ -1275,14 +1820,14 @@ def assign_current_move(scac, driver_id, move_id, origin=None, destination=None,
             'destination': destination,
             'container_number': container_number
         })
-    return requests.post(f'{carriers.get(scac)}move/current/assign', json=data)
+    return notify_carrier(scac, 'move/current/assign', data)
 
 
 def un_assign_current_move(scac, driver_id):
     data = {
         'driver_id': driver_id
     }
-    reply = requests.post(f'{carriers.get(scac)}move/current/unassign', json=data)
+    reply = notify_carrier(scac, 'move/current/unassign', data)
     return reply
 
 
@@ -1291,7 +1836,7 @@ def assign_next_move(scac, driver_id, move_id):
         'driver_id': driver_id,
         'move_id': move_id,
     }
-    reply = requests.post(f'{carriers.get(scac)}move/next/assign', json=data)
+    reply = notify_carrier(scac, 'move/next/assign', data)
     return reply
 
 
@@ -1299,7 +1844,7 @@ def un_assign_next_move(scac, driver_id):
     data = {
         'driver_id': driver_id
     }
-    reply = requests.post(f'{carriers.get(scac)}move/next/unassign', json=data)
+    reply = notify_carrier(scac, 'move/next/unassign', data)
     return reply
 
 
@@ -1313,10 +1858,152 @@ def update_move_status(scac, driver_id, new_status, container_number=None, desti
             'container_number': container_number,
             'destination': destination
         })
-    reply = requests.post(f'{carriers.get(scac)}move/current/new_status', json=data)
+    reply = notify_carrier(scac, 'move/current/new_status', data)
     return reply
 
 
+@app.route('/smartsheet/webhook', methods=['POST'])
+def smartsheet_webhook():
+    """
+    SS webhook callbacks for the open move log.
+    Answers the verification challenge, then saves the rows of every event for a targeted sync,
+    picked up by webhook_callbacks_watcher in every worker.
+    Callbacks are checked against config.smartsheet_webhook_secret, and refused while it isn't set:
+    only the challenge is answered then, as registering a webhook comes before its secret is known.
+    """
+    payload = request.get_json(silent=True) or {}
+
+    challenge = payload.get('challenge') or request.headers.get('Smartsheet-Hook-Challenge')
+    if challenge:
+        return {'smartsheetHookResponse': challenge}, 200, {'Smartsheet-Hook-Response': challenge}
+
+    secret = getattr(config, 'smartsheet_webhook_secret', None)
+    if not secret:
+        app.logger.warning('SS webhook callback refused, smartsheet_webhook_secret is not configured')
+        return '', 403
+
+    signature = hmac.new(secret.encode('utf-8'), request.get_data(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(signature, request.headers.get('Smartsheet-Hmac-SHA256', '')):
+        return '', 403
+
+    if 'newWebhookStatus' in payload:
+        app.logger.warning(f'SS webhook {payload.get("webhookId")} is now {payload["newWebhookStatus"]}')
+        callback = WebhookCallback(webhook_status=payload['newWebhookStatus'])
+
+    else:
+        sheet_id = payload.get('scopeObjectId')
+        if sheet_id not in OPEN_MOVES_LOG_SHEETS:
+            return '', 200
+
+        row_ids, sheet_changed = set(), False
+        for webhook_event in payload.get('events', []):
+            if webhook_event.get('objectType') == 'row':
+                row_ids.add(webhook_event['id'])
+            elif webhook_event.get('rowId') is not None:
+                row_ids.add(webhook_event['rowId'])
+            else:
+                sheet_changed = True  # sheet, column... events
+
+        callback = WebhookCallback(sheet_id, row_ids, sheet_changed)
+
+    db.session.add(callback)
+    WebhookCallback.query.filter(WebhookCallback.modified_at < datetime.now() - timedelta(hours=1)).delete()
+    db.session.commit()
+    return '', 200
+
+
+def apply_webhook_callbacks(changes):
+    for previous, callback in changes:
+        if previous is not None or callback is None:
+            continue  # callbacks are only ever inserted, then deleted
+
+        if callback['webhook_status'] is not None:
+            # SS disables webhooks it can't reach, polling takes over again until it's re-enabled
+            workflow_sync.webhook_active = callback['webhook_status'] == 'ENABLED'
+        else:
+            workflow_sync.mark_dirty(callback['sheet_id'], json.loads(callback['row_ids']),
+                                     sheet_changed=callback['sheet_changed'])
+
+
+# callbacks reach one worker, every worker syncs its own snapshot from them
+webhook_callbacks_watcher = RowWatcher(app, db, WebhookCallback,
+                                       ('sheet_id', 'row_ids', 'sheet_changed', 'webhook_status'),
+                                       apply_webhook_callbacks,
+                                       interval=getattr(config, 'webhook_callbacks_watch_interval', 2))
+
+
+OPEN_MOVES_WATCHED_COLUMNS = ('id', 'move_id', 'driver_id', 'container_number', 'customer', 'origin', 'destination',
+                              'scac', 'status', 'ss_status', 'truck_number')
+
+
+def publish_open_move_changes(changes):
+    change_feed.publish('open_move', [(*change_keys(previous, current),
+                                       compact_change({'id': (current or previous)['id'],
+                                                       'move_id': (current or previous)['move_id']},
+                                                      previous, current))
+                                      for previous, current in changes])
+
+
+open_moves_watcher = RowWatcher(app, db, OpenMoves, OPEN_MOVES_WATCHED_COLUMNS, publish_open_move_changes,
+                                interval=getattr(config, 'open_moves_watch_interval', 5))
+
+
+@app.route('/events', methods=['GET'])
+@login_required
+def events():
+    """
+    Server-sent events of the workflow and open moves changes, ?location=...&customer=... (repeatable) to filter.
+    'workflow' and 'open_move' events hold a list of changes with only the fields that changed,
+    'reset' means changes were missed and the lists should be reloaded.
+    """
+    open_moves_watcher.start()
+    workflow_sync.start()
+
+    stream = change_feed.stream(customers=request.args.getlist('customer'),
+                                locations=request.args.getlist('location'),
+                                last_event_id=request.headers.get('Last-Event-ID'))
+
+    # not stream_with_context, the request's db session would be held for as long as the client listens
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+metrics.callback('workflow_moves', 'Moves in the workflow snapshot', lambda: len(workflow_sync.last_snapshot))
+metrics.callback('workflow_sync_lag_seconds', 'Seconds since the sheet versions were last checked',
+                 lambda: workflow_sync.seconds_since_check)
+metrics.callback('workflow_rows_touched_total', 'Rows inserted, updated or deleted by workflow syncs',
+                 lambda: workflow_sync.rows_touched_total, kind='counter')
+metrics.callback('smartsheet_round_trips_saved_total', 'get_row calls answered from the workflow snapshot instead',
+                 lambda: ss_round_trips_saved, kind='counter')
+metrics.callback('smartsheet_rate_limit_queue_depth', 'SS calls waiting for a rate limit token',
+                 lambda: {(priority,): depth for priority, depth in ss_rate_limiter.queue_depth().items()},
+                 labels=('priority',))
+metrics.callback('smartsheet_rate_limit_wait_seconds_total', 'Seconds SS calls waited for a rate limit token',
+                 lambda: {(priority,): seconds for priority, seconds in ss_rate_limiter.wait_seconds.items()},
+                 kind='counter', labels=('priority',))
+metrics.callback('smartsheet_rate_limited_total', 'SS calls answered with a 429',
+                 lambda: ss_rate_limiter.rate_limited, kind='counter')
+metrics.callback('carrier_driver_cache_hits_total', 'get_driver calls answered from the cache',
+                 lambda: carrier_client.driver_cache_hits, kind='counter')
+metrics.callback('carrier_driver_cache_misses_total', 'get_driver calls sent to the carrier',
+                 lambda: carrier_client.driver_cache_misses, kind='counter')
+metrics.callback('archive_last_run_moved', 'Moves archived by the last archiver run', lambda: move_archiver.last_run_moved)
+metrics.callback('change_feed_subscribers', 'Open /events streams', lambda: change_feed.subscriber_count)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Metrics of this process in the Prometheus text format.
+    Requires 'Authorization: Bearer <config.metrics_token>', denied to everyone while no token is configured.
+    """
+    token = getattr(config, 'metrics_token', None)
+    if not token or not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return '', 403
+
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+
 @app.route('/test', methods=['GET', 'POST'])
 @login_required
 def test():
@@ -1335,7 +2022,7 @@ def test():
     if hasattr(new_user_type, '__iter__') and not isinstance(new_user_type, str):
         new_user_type = new_user_type[0]
 
-    user = User.query.filter_by(id=int(current_user.get_real_id())).first()
+    user = current_user
     user.type = new_user_type
     db.session.commit()
     return redirect(url_for('test'), 302)
@@ -1343,66 +2030,59 @@ def test():
     import time
     st = time.time()
     # r = requests.get(f'{carriers.get("BMKJ")}get_driver/BM-1391', )
-    update_workflow_list()
+    workflow_sync.refresh()
     et = time.time()
     elapsed_time = et - st
     return f'Execution time: {elapsed_time} seconds'
 
 
 def update_move_id_row(row_id, new_scac=None, new_truck=None, new_driver_id=None, new_status=None, new_comment=None,
-                       new_update=None):
-    row_to_update = ss_client.Sheets.get_row(
-        OPEN_MOVES_LOG_SHEETS,
-        row_id
-    )
+                       new_update=None, wait=False):
+    """
+    Queue an update of a move row in SS and apply it on the workflow snapshot right away.
+    The write goes to the sheet the row was read from.
+    None leaves a cell as it is, an empty value clears it.
 
-    try:
-        if row_to_update.result:
-            return False
-    except:
-        pass
+    :param wait: True to flush the write queue of the sheet and wait for SS
+    """
+    # existence is checked on the snapshot instead of a get_row round trip,
+    # a row deleted since the last sync is reported by the write itself
+    move = workflow_sync.snapshot().rows.get(row_id)
+    if move is None:
+        return False
 
-    new_row = smartsheet.models.Row()
-    new_row.id = row_id
+    new_fields = {}  # WorkflowMove field: new value, None to clear the cell
 
     if new_scac is not None:
-        new_cell = smartsheet.models.Cell()
-        new_cell.column_id = 4303620233553796  # 'Shuttle Provider SCAC'
-        new_cell.value = new_scac if new_scac else ''
-        new_row.cells.append(new_cell)
+        new_fields['scac'] = new_scac if new_scac else None
 
     if new_driver_id is not None:
-        new_cell = smartsheet.models.Cell()
-        new_cell.column_id = 222233071249284  # 'Driver Name (Last, First)'
-        new_cell.value = new_driver_id if new_driver_id else ''
-        new_row.cells.append(new_cell)
+        new_fields['driver_id'] = new_driver_id if new_driver_id else None
 
     if new_truck is not None:
-        new_cell = smartsheet.models.Cell()
-        new_cell.column_id = 8807219860924292  # 'Truck Number'
-        new_cell.value = new_truck if new_truck else ''
-        new_row.cells.append(new_cell)
+        new_fields['truck_number'] = new_truck if new_truck else None
 
     if new_status is not None:
-        new_cell = smartsheet.models.Cell()
-        new_cell.column_id = 4725832698619780  # 'Status'
-        new_cell.value = new_status if new_status else ''
-        new_row.cells.append(new_cell)
+        new_fields['ss_status'] = new_status if new_status else None
 
     if new_comment is not None:
-        new_cell = smartsheet.models.Cell()
-        new_cell.column_id = 2474032884934532  # 'Comments'
-        new_cell.value = new_comment if new_comment else ''
-        new_row.cells.append(new_cell)
-
-    updated_row = ss_client.Sheets.update_rows(
-        OPEN_MOVES_LOG_SHEETS,  # sheet_id
-        [new_row]  # an array of rows to update
-    )
+        new_fields['comments'] = new_comment if new_comment else None
 
     if new_update is not None:
         pass  # TODO: add a comment on a row, this is a placeholder.
 
+    if not new_fields:
+        return [] if wait else None  # nothing to write, same as a write SS took
+
+    global ss_round_trips_saved
+    ss_round_trips_saved += 1
+
+    write_columns = sheet_write_columns[move.sheet_id]
+    new_cells = {write_columns[field]: value if value is not None else '' for field, value in new_fields.items()}
+
+    updated_row = row_write_queues[move.sheet_id].put(row_id, new_cells, wait=wait)
+    workflow_sync.update_move(row_id, **new_fields)
+
     return updated_row
 
 
@@ -0,0 +1,132 @@
+import time
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, insert, or_, update
+
+from utils import BackgroundWorker, Lease
+
+logger = logging.getLogger(__name__)
+
+ISSUE_STATUSES = ('ISSUE', 'DAMAGED', 'ISSUE_OTW')
+
+
+class MoveArchiver(BackgroundWorker):
+    """
+    Moves finished moves from OpenMoves to CompletedMoves, from a background thread.
+    DELIVERED moves are archived right away, moves with an issue once they haven't changed for issue_after.
+
+    Rows are copied then deleted batch by batch, walking open moves by id from a high-water mark,
+    with a pause between batches to leave the databases to the gate.
+    A copy is skipped if CompletedMoves already has the same (move_id, driver_id, created_at),
+    so a run interrupted between the copy and the delete can simply be run again.
+
+    Every worker starts an archiver, a run first takes a lease on the single row of the state table,
+    so only one process archives at a time. The high-water mark is saved there along with every batch,
+    a run interrupted by a crash resumes where it stopped.
+
+    :param app: flask app, for the app context of the background thread
+    :param db: flask_sqlalchemy db
+    :param open_model: OpenMoves
+    :param completed_model: CompletedMoves
+    :param state_model: model with id, high_water_mark, locked_by and locked_until columns, in the bind of open_model
+    :param interval: seconds between two runs
+    :param batch_size: moves per batch
+    :param pause: seconds between two batches
+    :param issue_after: timedelta after which a move with an issue is archived
+    :param lease: seconds a run keeps its lease without finishing a batch
+    """
+
+    def __init__(self, app, db, open_model, completed_model, state_model, interval=600, batch_size=100, pause=0.5,
+                 issue_after=timedelta(hours=72), lease=300):
+        self.app = app
+        self.db = db
+        self.open_model = open_model
+        self.completed_model = completed_model
+        self.state_model = state_model
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.issue_after = issue_after
+        self.lease = lease
+        super().__init__('move-archiver', app)
+
+        self.last_run_moved = 0
+        self._lease = Lease(db, state_model, seconds=lease)
+        self._columns = [column.name for column in open_model.__table__.columns if column.name != 'id']
+
+    def run(self):
+        """Archive every finished move, returns how many were moved, None if another process is archiving."""
+        if not self._claim():
+            return None
+
+        moved = 0
+        high_water_mark = self.db.session.get(self.state_model, 1).high_water_mark or 0
+        try:
+            while True:
+                batch = (self.open_model.query
+                         .filter(self.open_model.id > high_water_mark, self._is_finished())
+                         .order_by(self.open_model.id)
+                         .limit(self.batch_size)
+                         .all())
+
+                if not batch:
+                    high_water_mark = 0  # next run starts over, for moves finished since
+                    break
+
+                # read before _move commits, the instances expire then and their rows are deleted
+                ids = [move.id for move in batch]
+                rows = [{column: getattr(move, column) for column in self._columns} for move in batch]
+                moved += self._move(ids, rows)
+                high_water_mark = ids[-1]
+                time.sleep(self.pause)
+
+                if not self._claim():
+                    logger.warning('Move archiver lost its lease, stopping')
+                    return moved
+        finally:
+            self.db.session.rollback()
+            self._release(high_water_mark)
+
+        self.last_run_moved = moved
+        logger.info(f'Archived {moved} moves')
+        return moved
+
+    def _claim(self):
+        """Take or renew the lease on the state row, False if another process holds it."""
+        return self._lease.claim()
+
+    def _release(self, high_water_mark):
+        self._lease.release(high_water_mark=high_water_mark)
+
+    def _is_finished(self):
+        model = self.open_model
+        return or_(model.status == 'DELIVERED',
+                   and_(model.status.in_(ISSUE_STATUSES), model.modified_at < datetime.now() - self.issue_after))
+
+    def _move(self, ids, rows):
+        """
+        Copy then delete a batch of open moves.
+
+        :param ids: ids of the open moves, ascending
+        :param rows: {column: value} of the open moves, without id
+        """
+        completed = self.completed_model
+
+        archived = {tuple(archived_move) for archived_move in
+                    self.db.session.query(completed.move_id, completed.driver_id, completed.created_at)
+                    .filter(completed.created_at.in_([row['created_at'] for row in rows]))}
+        new_rows = [row for row in rows if (row['move_id'], row['driver_id'], row['created_at']) not in archived]
+
+        if new_rows:
+            self.db.session.execute(insert(completed), new_rows)
+        self.db.session.commit()
+
+        self.open_model.query.filter(self.open_model.id.in_(ids)).delete(synchronize_session=False)
+        self.db.session.execute(update(self.state_model).where(self._lease.held()).values(high_water_mark=ids[-1]))
+        self.db.session.commit()
+
+        return len(ids)
+
+    def _step(self):
+        self.run()
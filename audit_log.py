@@ -0,0 +1,104 @@
+import queue
+import logging
+import threading
+from datetime import datetime
+
+from utils import BackgroundWorker
+
+logger = logging.getLogger(__name__)
+
+
+class AuditLogWriter(BackgroundWorker):
+    """
+    Writes SiteLog/MoveLog records to the log bind, without going through the request's db session.
+
+    In 'sync' mode every record is inserted right away.
+    In 'batched' mode records are queued in memory and bulk inserted by a background thread
+    every flush_interval seconds or once batch_size records are waiting,
+    a full queue is flushed by the caller instead of dropping records.
+
+    :param app: flask app, for the app context of the background thread
+    :param db: flask_sqlalchemy db
+    :param bind: bind key of the log tables
+    :param mode: 'sync'/'batched'
+    :param batch_size: records waiting before the background thread is woken up early
+    :param flush_interval: seconds between two flushes of the background thread
+    :param max_queue: max records waiting in memory
+    """
+
+    def __init__(self, app, db, bind='log', mode='batched', batch_size=100, flush_interval=1.0, max_queue=10000):
+        self.app = app
+        self.db = db
+        self.bind = bind
+        self.mode = mode
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        super().__init__('audit-log')
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._flush_lock = threading.Lock()
+
+    def add(self, model, **values):
+        """
+        Log a record, created_at is the time of the call even if the insert happens later.
+
+        :param model: SiteLog/MoveLog
+        :param values: column values of the record
+        """
+        now = datetime.now()
+        values.setdefault('created_at', now)
+        values.setdefault('modified_at', now)
+
+        if self.mode == 'sync':
+            self._insert([(model, values)])
+            return
+
+        self.start()
+        try:
+            self._queue.put_nowait((model, values))
+        except queue.Full:
+            self.flush()
+            self._queue.put_nowait((model, values))
+
+        if self._queue.qsize() >= self.batch_size:
+            self.wake()
+
+    def flush(self):
+        """Insert every queued record, also registered to run at exit."""
+        with self._flush_lock:
+            records = []
+            while True:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if not records:
+                return
+
+            try:
+                with self.app.app_context():
+                    self._insert(records)
+            except Exception:
+                for record in records:
+                    try:
+                        self._queue.put_nowait(record)
+                    except queue.Full:
+                        logger.error(f'Audit log queue is full, dropped {record}')
+                raise
+
+    def _insert(self, records):
+        """One transaction for all records, with a bulk insert per table."""
+        tables = {}
+        for model, values in records:
+            tables.setdefault(model.__table__, []).append(values)
+
+        with self.db.engines[self.bind].begin() as connection:
+            for table, rows in tables.items():
+                connection.execute(table.insert(), rows)
+
+    def _interval(self):
+        return self.flush_interval
+
+    def _step(self):
+        self.flush()
@@ -0,0 +1,139 @@
+"""
+Requests per second of the assignment path with each audit log mode.
+
+    python benchmarks/audit_log_modes.py [--threads 8] [--seconds 5] [--profile]
+
+An assignment updates an open move and commits, then logs a MoveLog and a SiteLog record, in SQLite files
+of a temporary directory, from concurrent threads standing in for request threads:
+inline is how logs were written before the writer, added to the request's session with a commit each,
+sync and batched are the AuditLogWriter modes. --profile applies the SQLite profile to every bind first.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import threading
+
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from audit_log import AuditLogWriter  # noqa: E402
+from sqlite_profile import apply_sqlite_profile  # noqa: E402
+
+MOVES = 1000
+
+
+def build_app(directory):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(directory, "database.db")}'
+    app.config['SQLALCHEMY_BINDS'] = {'log': f'sqlite:///{os.path.join(directory, "logs.db")}'}
+    db = SQLAlchemy(app)
+
+    class OpenMoves(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        driver_id = db.Column(db.String(16))
+        status = db.Column(db.String(32))
+
+    class SiteLog(db.Model):
+        __bind_key__ = 'log'
+        id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+        action_type = db.Column(db.String(64))
+        by_user = db.Column(db.String(256))
+        detailed_info = db.Column(db.String(2048))
+        created_at = db.Column(db.DateTime, default=db.func.localtimestamp())
+        modified_at = db.Column(db.DateTime, default=db.func.localtimestamp())
+
+    class MoveLog(db.Model):
+        __bind_key__ = 'log'
+        id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+        action_type = db.Column(db.String(64))
+        by_user = db.Column(db.String(256))
+        driver_id = db.Column(db.String(16))
+        move_id = db.Column(db.String(24), index=True)
+        created_at = db.Column(db.DateTime, default=db.func.localtimestamp())
+        modified_at = db.Column(db.DateTime, default=db.func.localtimestamp())
+
+    return app, db, OpenMoves, SiteLog, MoveLog
+
+
+def assign(db, models, audit_log, mode, rng):
+    open_moves, site_log, move_log = models
+    move = db.session.get(open_moves, rng.randrange(1, MOVES + 1))
+    move.driver_id = f'AB-{rng.randrange(10000):04d}'
+    move.status = 'FOUND'
+    db.session.commit()
+
+    move_log_values = {'action_type': 'ASSIGN', 'by_user': 'gate@example.com', 'driver_id': move.driver_id,
+                       'move_id': f'MV{move.id:08d}'}
+    site_log_values = {'action_type': 'ASSIGN', 'by_user': 'gate@example.com', 'detailed_info': 'benchmark'}
+
+    if mode == 'inline':
+        db.session.add(move_log(**move_log_values))
+        db.session.commit()
+        db.session.add(site_log(**site_log_values))
+        db.session.commit()
+    else:
+        audit_log.add(move_log, **move_log_values)
+        audit_log.add(site_log, **site_log_values)
+
+
+def run(mode, threads, seconds, profile):
+    with tempfile.TemporaryDirectory() as directory:
+        app, db, *models = build_app(directory)
+        with app.app_context():
+            if profile:
+                apply_sqlite_profile(db)
+            db.create_all()
+            db.session.add_all([models[0](id=index, status='PENDING') for index in range(1, MOVES + 1)])
+            db.session.commit()
+
+        audit_log = AuditLogWriter(app, db, mode='sync' if mode == 'inline' else mode)
+        done = [0] * threads
+        errors = []
+        deadline = time.monotonic() + seconds
+
+        def worker(index):
+            rng = random.Random(index)
+            while time.monotonic() < deadline:
+                with app.app_context():
+                    try:
+                        assign(db, models, audit_log, mode, rng)
+                        done[index] += 1
+                    except Exception as e:  # 'database is locked' without the profile's busy_timeout
+                        errors.append(e)
+                        db.session.rollback()
+
+        workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        audit_log.flush()
+
+        with app.app_context():
+            logged = db.session.query(models[2]).count()
+            for engine in db.engines.values():
+                engine.dispose()
+
+    return sum(done) / seconds, len(errors), logged
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--profile', action='store_true', help='apply the SQLite profile (WAL...)')
+    options = parser.parse_args()
+
+    print(f'{"mode":<8} {"req/s":>8} {"errors":>7} {"move logs":>10}')
+    for mode in ('inline', 'sync', 'batched'):
+        rate, errors, logged = run(mode, options.threads, options.seconds, options.profile)
+        print(f'{mode:<8} {rate:>8.0f} {errors:>7} {logged:>10}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Carrier API latency against a local stub carrier, a new connection per call against the pooled CarrierClient.
+
+    python benchmarks/carrier_stub.py [--calls 500] [--threads 8] [--handshake-delay 0.02] [--latency 0.005]
+
+The stub answers get_driver/<shuttle_id> and the move/... posts. Every new connection waits handshake_delay
+before being served, standing in for the TCP and TLS handshakes with a remote carrier.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from carrier_client import CarrierClient  # noqa: E402
+
+
+class StubCarrier(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+    disable_nagle_algorithm = True  # headers and body are written apart, don't wait for the delayed ack in between
+    handshake_delay = 0
+    latency = 0
+    connections = 0
+    _lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with StubCarrier._lock:
+            StubCarrier.connections += 1
+        time.sleep(self.handshake_delay)
+
+    def do_GET(self):
+        shuttle_id = self.path.rsplit('/', 1)[-1]
+        self._reply({'driver_id': shuttle_id, 'current_move': None, 'next_move': None})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._reply({'status': 'ok'})
+
+    def _reply(self, body):
+        time.sleep(self.latency)
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def unpooled_call(base_url, index):
+    if index % 2:
+        return requests.post(f'{base_url}move/current/new', json={'driver_id': f'AB-{index:04d}'})
+    return requests.get(f'{base_url}get_driver/AB-{index:04d}')
+
+
+def pooled_call(carrier_client, index):
+    if index % 2:
+        return carrier_client.post('STUB', 'move/current/new', json={'driver_id': f'AB-{index:04d}'})
+    return carrier_client.get('STUB', f'get_driver/AB-{index:04d}')
+
+
+def run(call, calls, threads):
+    def timed(index):
+        started_at = time.perf_counter()
+        call(index).raise_for_status()
+        return time.perf_counter() - started_at
+
+    connections = StubCarrier.connections
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        seconds = list(pool.map(timed, range(calls)))
+    elapsed = time.perf_counter() - started_at
+    seconds.sort()
+    return (statistics.median(seconds) * 1000, seconds[int(len(seconds) * 0.99)] * 1000, calls / elapsed,
+            StubCarrier.connections - connections)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--calls', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--handshake-delay', type=float, default=0.02, help='seconds per new connection')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds per request')
+    options = parser.parse_args()
+
+    StubCarrier.handshake_delay = options.handshake_delay
+    StubCarrier.latency = options.latency
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubCarrier)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}/'
+
+    carrier_client = CarrierClient({'STUB': base_url}, default_pool_size=options.threads)
+    results = {'unpooled': run(lambda index: unpooled_call(base_url, index), options.calls, options.threads),
+               'pooled': run(lambda index: pooled_call(carrier_client, index), options.calls, options.threads)}
+    server.shutdown()
+
+    print(f'{"":<9} {"p50":>9} {"p99":>9} {"calls/s":>9} {"connections":>12}')
+    for name, (p50, p99, rate, connections) in results.items():
+        print(f'{name:<9} {p50:>7.1f}ms {p99:>7.1f}ms {rate:>9.0f} {connections:>12}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Check-in candidate lookup as the open move log grows, scan of every move against the snapshot index.
+
+    python benchmarks/checkin_candidates.py [--sizes 1000 5000 10000 25000 50000] [--checkins 2000]
+
+Every check-in looks up the unassigned moves of a customer leaving from the driver's location and from
+the destination of their container, for the driver's carrier and for no carrier yet, as driver_w_shuttle_id does.
+The scan latency grows with the sheet, the index lookup should stay flat.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from workflow import WorkflowMove, WorkflowSnapshot  # noqa: E402
+
+CUSTOMERS = [f'CUSTOMER {index}' for index in range(20)]
+LOCATIONS = [f'LOCATION {index}' for index in range(12)]
+SCACS = ['ABCD', 'EFGH', 'IJKL', 'MNOP', None]
+
+
+def snapshot_of(size, rng):
+    moves = {}
+    for index in range(size):
+        move_id = f'MV{index:08d}'
+        moves[move_id] = WorkflowMove(move_id, index, f'CONT{index:07d}', 'LOADED', 'ST', rng.choice(CUSTOMERS),
+                                      rng.choice(LOCATIONS), rng.choice(LOCATIONS), rng.choice(SCACS), None,
+                                      f'AB-{index:04d}' if rng.random() < 0.7 else None, 'OPEN', None, 1)
+    return WorkflowSnapshot({1: 1}, moves, {move.row_id: move for move in moves.values()})
+
+
+def scan(workflow, customer, origin, destination, scac):
+    """Candidates the way check-ins found them before the index, every move of the sheet visited."""
+    current, current_no_scac, opposite, opposite_no_scac = [], [], [], []
+    for move in workflow.values():
+        if move.customer == customer and not move.driver_id:
+            if move.origin == origin:
+                if move.scac == scac:
+                    current.append(move.move_id)
+                elif move.scac is None:
+                    current_no_scac.append(move.move_id)
+            elif move.origin == destination:
+                if move.scac == scac:
+                    opposite.append(move.move_id)
+                elif move.scac is None:
+                    opposite_no_scac.append(move.move_id)
+    return current + current_no_scac, opposite + opposite_no_scac
+
+
+def lookup(workflow, customer, origin, destination, scac):
+    current = list(workflow.candidates(customer, origin, scac)) + list(workflow.candidates(customer, origin, None))
+    opposite = (list(workflow.candidates(customer, destination, scac))
+                + list(workflow.candidates(customer, destination, None)))
+    return current, opposite
+
+
+def time_checkins(find, workflow, checkins):
+    seconds = []
+    for customer, origin, destination, scac in checkins:
+        started_at = time.perf_counter()
+        find(workflow, customer, origin, destination, scac)
+        seconds.append(time.perf_counter() - started_at)
+    return statistics.median(seconds) * 1e6, sorted(seconds)[int(len(seconds) * 0.99)] * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 10000, 25000, 50000])
+    parser.add_argument('--checkins', type=int, default=2000)
+    options = parser.parse_args()
+
+    rng = random.Random(3)
+    print(f'{"moves":>7}  {"scan p50":>10}  {"scan p99":>10}  {"index p50":>10}  {"index p99":>10}')
+    for size in options.sizes:
+        workflow = snapshot_of(size, rng)
+        checkins = [(rng.choice(CUSTOMERS), rng.choice(LOCATIONS), rng.choice(LOCATIONS), rng.choice(SCACS[:-1]))
+                    for _ in range(options.checkins)]
+
+        for checkin in checkins[:50]:
+            current, opposite = lookup(workflow, *checkin)
+            scanned_current, scanned_opposite = scan(workflow, *checkin)
+            if checkin[1] != checkin[2]:
+                assert sorted(current) == sorted(scanned_current) and sorted(opposite) == sorted(scanned_opposite)
+
+        scan_p50, scan_p99 = time_checkins(scan, workflow, checkins[:max(50, options.checkins * 1000 // size)])
+        lookup_p50, lookup_p99 = time_checkins(lookup, workflow, checkins)
+        print(f'{size:>7}  {scan_p50:>8.1f}µs  {scan_p99:>8.1f}µs  {lookup_p50:>8.2f}µs  {lookup_p99:>8.2f}µs')
+
+
+if __name__ == '__main__':
+    main()
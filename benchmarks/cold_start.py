@@ -0,0 +1,75 @@
+"""
+Cold start of a worker, full download of the open move log against loading the saved workflow snapshot.
+
+    python benchmarks/cold_start.py [--rows 20000] [--latency 1.5] [--runs 5]
+
+The SS client is a stand-in answering get_sheet with generated rows after latency seconds,
+about what a full download of a large sheet takes; set it to the time the real one takes.
+The snapshot is saved by a first sync, then every run starts from a new WorkflowSync as a new worker would.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from workflow import CELL_FIELDS, WorkflowSync  # noqa: E402
+
+COL_NAMES = {1000 + index: field for index, field in enumerate(CELL_FIELDS)}
+
+
+class StandInSheets:
+    def __init__(self, rows, latency):
+        self.latency = latency
+        self.columns = [SimpleNamespace(id=column_id, title=field) for column_id, field in COL_NAMES.items()]
+        self.rows = [SimpleNamespace(id=index, modified_at=None,
+                                     cells=[SimpleNamespace(column_id=column_id, display_value=f'{field} {index}')
+                                            for column_id, field in COL_NAMES.items()])
+                     for index in range(rows)]
+
+    def get_sheet_version(self, sheet_id):
+        return SimpleNamespace(version=1)
+
+    def get_sheet(self, sheet_id, **kwargs):
+        time.sleep(self.latency)
+        return SimpleNamespace(columns=self.columns, rows=self.rows, total_row_count=len(self.rows))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--latency', type=float, default=1.5, help='seconds a full download takes')
+    parser.add_argument('--runs', type=int, default=5)
+    options = parser.parse_args()
+
+    ss_client = SimpleNamespace(Sheets=StandInSheets(options.rows, options.latency))
+
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot_path = os.path.join(directory, 'workflow_snapshot.pickle')
+        WorkflowSync(ss_client, {1: COL_NAMES}, incremental=False, snapshot_path=snapshot_path).refresh()
+        snapshot_size = os.path.getsize(snapshot_path)
+
+        download, load = [], []
+        for _ in range(options.runs):
+            workflow_sync = WorkflowSync(ss_client, {1: COL_NAMES}, incremental=False)
+            started_at = time.perf_counter()
+            workflow_sync.refresh()
+            download.append(time.perf_counter() - started_at)
+
+            workflow_sync = WorkflowSync(ss_client, {1: COL_NAMES}, incremental=False, snapshot_path=snapshot_path)
+            started_at = time.perf_counter()
+            assert workflow_sync.load()
+            load.append(time.perf_counter() - started_at)
+            assert len(workflow_sync.last_snapshot) == options.rows
+
+    print(f'{options.rows} rows, snapshot file {snapshot_size / 2 ** 20:.1f} MiB')
+    for name, seconds in (('download', download), ('load', load)):
+        print(f'{name:<9} median {statistics.median(seconds) * 1000:8.1f} ms   max {max(seconds) * 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Throughput of N concurrent logins, password hashed on the request threads against the hashing process pool.
+
+    python benchmarks/concurrent_logins.py [--logins 32] [--rounds 3] [--workers 2] [--max-pending 8]
+
+Every round starts all the logins at once, as gate operators do at shift start.
+A probe thread meanwhile times a small piece of Python work every 10 ms, standing in for the other requests
+of the worker: its p99 shows how much they stall while passwords are hashed.
+"""
+import os
+import sys
+import hmac
+import time
+import argparse
+import statistics
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils  # noqa: E402
+
+
+def inline_login(password, stored_password):
+    """verify_pass as it was, PBKDF2 on the request thread."""
+    iterations, salt, stored_hash = utils._parse_hash(stored_password)
+    return hmac.compare_digest(utils._pbkdf2(password, salt, iterations), stored_hash)
+
+
+def probe(stop, seconds):
+    while not stop.is_set():
+        started_at = time.perf_counter()
+        sum(range(20000))
+        seconds.append(time.perf_counter() - started_at)
+        time.sleep(0.01)
+
+
+def run(login, stored_password, logins, rounds):
+    login_seconds, probe_seconds = [], []
+    stop = threading.Event()
+    probe_thread = threading.Thread(target=probe, args=(stop, probe_seconds))
+    probe_thread.start()
+
+    def timed_login():
+        started_at = time.perf_counter()
+        assert login('correct horse battery staple', stored_password)
+        login_seconds.append(time.perf_counter() - started_at)
+
+    started_at = time.perf_counter()
+    for _ in range(rounds):
+        threads = [threading.Thread(target=timed_login) for _ in range(logins)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started_at
+
+    stop.set()
+    probe_thread.join()
+    login_seconds.sort()
+    probe_seconds.sort()
+    return (len(login_seconds) / elapsed, statistics.median(login_seconds) * 1000,
+            login_seconds[int(len(login_seconds) * 0.99)] * 1000,
+            statistics.median(probe_seconds) * 1000, probe_seconds[int(len(probe_seconds) * 0.99)] * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--logins', type=int, default=32)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--iterations', type=int, default=utils.LEGACY_ITERATIONS)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--max-pending', type=int, default=8)
+    options = parser.parse_args()
+
+    utils.configure_password_hashing(iterations=options.iterations, workers=options.workers,
+                                     max_pending=options.max_pending)
+    stored_password = utils.hash_pass('correct horse battery staple')  # also starts the pool
+
+    print(f'{options.logins} concurrent logins x {options.rounds}, {options.iterations} iterations, '
+          f'{os.cpu_count()} CPUs')
+    print(f'{"":<8} {"logins/s":>9} {"login p50":>10} {"login p99":>10} {"probe p50":>10} {"probe p99":>10}')
+    for name, login in (('inline', inline_login), ('pool', utils.verify_pass)):
+        rate, login_p50, login_p99, probe_p50, probe_p99 = run(login, stored_password, options.logins,
+                                                               options.rounds)
+        print(f'{name:<8} {rate:>9.1f} {login_p50:>8.0f}ms {login_p99:>8.0f}ms '
+              f'{probe_p50:>8.2f}ms {probe_p99:>8.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Import-time profile of the app, and the setup create_app() runs afterwards.
+
+    python benchmarks/import_time.py [--runs 5] [--top 15]
+
+Every run is a fresh interpreter started from the repo root, as a forked worker or a CLI command would be,
+so config.py has to be there. Compare against the commit before the app factory to see the reduction.
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TIMED_IMPORT = """
+import sys, time, json
+started_at = time.perf_counter()
+import app
+imported_at = time.perf_counter()
+app.create_app()
+set_up_at = time.perf_counter()
+print(json.dumps({'import': imported_at - started_at, 'setup': set_up_at - imported_at,
+                  'smartsheet_imported': 'smartsheet' in sys.modules}))
+"""
+
+
+def run(*args):
+    return subprocess.run([sys.executable, *args], cwd=ROOT, capture_output=True, text=True, check=True)
+
+
+def slowest_imports(top):
+    """[(cumulative µs, module)] of the slowest imports of 'import app', from python -X importtime."""
+    stderr = run('-X', 'importtime', '-c', 'import app').stderr
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        imports.append((int(cumulative_us), module.rstrip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    options = parser.parse_args()
+
+    results = [json.loads(run('-c', TIMED_IMPORT).stdout.splitlines()[-1]) for _ in range(options.runs)]
+
+    for step in ('import', 'setup'):
+        seconds = [result[step] for result in results]
+        print(f'{step:<7} median {statistics.median(seconds) * 1000:8.1f} ms   '
+              f'min {min(seconds) * 1000:8.1f} ms   max {max(seconds) * 1000:8.1f} ms')
+    print(f"smartsheet SDK imported by 'import app' + create_app(): {results[0]['smartsheet_imported']}")
+
+    print('\nslowest imports of "import app" (cumulative):')
+    for cumulative_us, module in slowest_imports(options.top):
+        print(f'{cumulative_us / 1000:8.1f} ms  {module}')
+
+
+if __name__ == '__main__':
+    main()
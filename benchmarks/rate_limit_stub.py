@@ -0,0 +1,117 @@
+"""
+SS calls of every priority class against a local stub enforcing a rate limit, unthrottled against the RateLimiter.
+
+    python benchmarks/rate_limit_stub.py [--limit 10] [--seconds 10] [--writers 2] [--readers 4] [--syncs 4]
+
+The stub allows limit calls per sliding second and answers the others with a 429 error, raised like the SDK does.
+Gate writes, user reads and background syncs are sent from their own threads as fast as they come back,
+unthrottled they fail along with everything else, through the limiter gate writes go first.
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import threading
+from collections import deque
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rate_limit import (BACKGROUND_SYNC, GATE_WRITE, PRIORITY_NAMES, RATE_LIMITED_ERROR, USER_READ,  # noqa: E402
+                        LimitedClient, RateLimiter)
+
+
+class RateLimitedError(Exception):
+    """Stands in for smartsheet.exceptions.ApiError of a 429."""
+
+    def __init__(self):
+        super().__init__('Rate limit exceeded')
+        self.error = SimpleNamespace(result=SimpleNamespace(status_code=429, code=RATE_LIMITED_ERROR))
+
+
+class StubSheets:
+    def __init__(self, limit, latency=0.01):
+        self.limit = limit
+        self.latency = latency
+        self.rejected = 0
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def _call(self):
+        with self._lock:
+            now = time.monotonic()
+            while self._calls and self._calls[0] <= now - 1:
+                self._calls.popleft()
+            if len(self._calls) >= self.limit:
+                self.rejected += 1
+                raise RateLimitedError()
+            self._calls.append(now)
+        time.sleep(self.latency)
+
+    def update_rows(self, sheet_id, rows):
+        self._call()
+
+    def get_row(self, sheet_id, row_id):
+        self._call()
+
+    def get_sheet_version(self, sheet_id, *args):
+        self._call()
+
+
+def run(limiter, options):
+    sheets = StubSheets(options.limit)
+    client = SimpleNamespace(Sheets=sheets)
+    results = {priority: {'seconds': [], 'failed': 0} for priority in PRIORITY_NAMES}
+    deadline = time.monotonic() + options.seconds
+
+    def caller(priority, operation):
+        limited = client if limiter is None else LimitedClient(client, limiter, priority)
+        while time.monotonic() < deadline:
+            started_at = time.perf_counter()
+            try:
+                getattr(limited.Sheets, operation)(1, 1)
+            except RateLimitedError:
+                results[priority]['failed'] += 1
+                time.sleep(0.1)  # the caller gives up, the next one comes along
+                continue
+            results[priority]['seconds'].append(time.perf_counter() - started_at)
+
+    threads = ([threading.Thread(target=caller, args=(GATE_WRITE, 'update_rows')) for _ in range(options.writers)]
+               + [threading.Thread(target=caller, args=(USER_READ, 'get_row')) for _ in range(options.readers)]
+               + [threading.Thread(target=caller, args=(BACKGROUND_SYNC, 'get_sheet_version'))
+                  for _ in range(options.syncs)])
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, sheets.rejected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--limit', type=int, default=10, help='calls per second the stub allows')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--syncs', type=int, default=4)
+    options = parser.parse_args()
+
+    rate = options.limit * 0.9
+    limiter = RateLimiter(rate=rate, burst=max(1, int(options.limit - rate)), max_backoff=5)  # within a second
+    print(f'{"":<12} {"class":<16} {"ok/s":>6} {"failed":>7} {"p50":>9} {"p99":>9}')
+    for name, run_limiter in (('unthrottled', None), ('limiter', limiter)):
+        results, rejected = run(run_limiter, options)
+        for priority, result in results.items():
+            seconds = sorted(result['seconds'])
+            p50 = statistics.median(seconds) * 1000 if seconds else float('nan')
+            p99 = seconds[int(len(seconds) * 0.99)] * 1000 if seconds else float('nan')
+            print(f'{name:<12} {PRIORITY_NAMES[priority]:<16} {len(seconds) / options.seconds:>6.1f} '
+                  f'{result["failed"]:>7} {p50:>7.0f}ms {p99:>7.0f}ms')
+        print(f'{name:<12} 429 answered by the stub: {rejected}')
+
+    print(f'limiter wait seconds {limiter.wait_seconds}, max {limiter.max_wait_seconds}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Concurrent readers and writers on SQLite, default settings against the storage profile (pragmas and indexes).
+
+    python benchmarks/sqlite_concurrency.py [--readers 6] [--writers 2] [--seconds 5] [--moves 20000]
+
+Every reader and writer is its own process with its own engine, like the workers of the app.
+Readers run the hot lookups: open moves by (driver_id, move_id) and users by alternative_id.
+Writers update an open move and add a move log record, a commit each.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import statistics
+import multiprocessing
+from types import SimpleNamespace
+
+from sqlalchemy import Column, Index, Integer, MetaData, String, Table, create_engine, insert, select, update
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlite_profile import apply_sqlite_profile  # noqa: E402
+
+USERS = 2000
+
+
+def tables(indexed):
+    metadata = MetaData()
+    open_moves = Table('open_moves', metadata,
+                       Column('id', Integer, primary_key=True),
+                       Column('move_id', String(24)),
+                       Column('driver_id', String(16)),
+                       Column('status', String(32)))
+    users = Table('user', metadata,
+                  Column('id', Integer, primary_key=True),
+                  Column('alternative_id', Integer),
+                  Column('email', String(256)))
+    move_log = Table('move_log', metadata,
+                     Column('id', Integer, primary_key=True),
+                     Column('move_id', String(24)),
+                     Column('action_type', String(64)))
+    if indexed:
+        Index('ix_open_moves_driver_id_move_id', open_moves.c.driver_id, open_moves.c.move_id)
+        Index('ix_user_alternative_id', users.c.alternative_id, unique=True)
+        Index('ix_move_log_move_id', move_log.c.move_id)
+    return metadata, open_moves, users, move_log
+
+
+def engine_for(path, profiled):
+    engine = create_engine(f'sqlite:///{path}')  # the sqlite3 module waits 5 s on a locked database either way
+    if profiled:
+        apply_sqlite_profile(SimpleNamespace(engines={None: engine}))
+    return engine
+
+
+def populate(path, profiled, moves):
+    metadata, open_moves, users, move_log = tables(profiled)
+    engine = engine_for(path, profiled)
+    metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(open_moves), [{'id': index, 'move_id': f'MV{index:08d}',
+                                                 'driver_id': f'AB-{index % 5000:04d}', 'status': 'PENDING'}
+                                                for index in range(1, moves + 1)])
+        connection.execute(insert(users), [{'id': index, 'alternative_id': index * 7919, 'email': f'{index}@gate'}
+                                           for index in range(1, USERS + 1)])
+    engine.dispose()
+
+
+def reader(path, profiled, moves, started_at, deadline, results):
+    metadata, open_moves, users, move_log = tables(profiled)
+    engine = engine_for(path, profiled)
+    rng = random.Random(os.getpid())
+    seconds, errors = [], 0
+    time.sleep(max(0, started_at - time.time()))
+    while time.time() < deadline:
+        index = rng.randrange(1, moves + 1)
+        call_started_at = time.perf_counter()
+        try:
+            with engine.connect() as connection:
+                connection.execute(select(open_moves).where(open_moves.c.driver_id == f'AB-{index % 5000:04d}',
+                                                            open_moves.c.move_id == f'MV{index:08d}')).all()
+                connection.execute(select(users).where(users.c.alternative_id == rng.randrange(1, USERS) * 7919)).all()
+        except Exception:
+            errors += 1
+            continue
+        seconds.append(time.perf_counter() - call_started_at)
+    results.put(('read', seconds, errors))
+
+
+def writer(path, profiled, moves, started_at, deadline, results):
+    metadata, open_moves, users, move_log = tables(profiled)
+    engine = engine_for(path, profiled)
+    rng = random.Random(os.getpid())
+    seconds, errors = [], 0
+    time.sleep(max(0, started_at - time.time()))
+    while time.time() < deadline:
+        index = rng.randrange(1, moves + 1)
+        call_started_at = time.perf_counter()
+        try:
+            with engine.begin() as connection:
+                connection.execute(update(open_moves).where(open_moves.c.id == index).values(status='FOUND'))
+                connection.execute(insert(move_log).values(move_id=f'MV{index:08d}', action_type='ASSIGN'))
+        except Exception:  # database is locked
+            errors += 1
+            continue
+        seconds.append(time.perf_counter() - call_started_at)
+    results.put(('write', seconds, errors))
+
+
+def run(profiled, options):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'database.db')
+        populate(path, profiled, options.moves)
+
+        results = multiprocessing.Queue()
+        started_at = time.time() + 1  # a second to start the processes
+        args = (path, profiled, options.moves, started_at, started_at + options.seconds, results)
+        processes = ([multiprocessing.Process(target=reader, args=args) for _ in range(options.readers)]
+                     + [multiprocessing.Process(target=writer, args=args) for _ in range(options.writers)])
+        for process in processes:
+            process.start()
+        collected = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+    summary = {}
+    for kind in ('read', 'write'):
+        seconds = sorted(second for result_kind, result_seconds, _ in collected if result_kind == kind
+                         for second in result_seconds)
+        errors = sum(result_errors for result_kind, _, result_errors in collected if result_kind == kind)
+        summary[kind] = (len(seconds) / options.seconds,
+                         statistics.median(seconds) * 1000 if seconds else float('nan'),
+                         seconds[int(len(seconds) * 0.99)] * 1000 if seconds else float('nan'),
+                         errors)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--readers', type=int, default=6)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--moves', type=int, default=20000)
+    options = parser.parse_args()
+
+    print(f'{"":<9} {"":<6} {"ops/s":>8} {"p50":>9} {"p99":>9} {"errors":>7}')
+    for name, profiled in (('default', False), ('profile', True)):
+        for kind, (rate, p50, p99, errors) in run(profiled, options).items():
+            print(f'{name:<9} {kind:<6} {rate:>8.0f} {p50:>7.2f}ms {p99:>7.2f}ms {errors:>7}')
+
+
+if __name__ == '__main__':
+    main()
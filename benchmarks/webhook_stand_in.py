@@ -0,0 +1,78 @@
+"""
+Local stand-in for SS webhooks, posts callbacks to a running app the way SS does.
+
+    python benchmarks/webhook_stand_in.py http://127.0.0.1:5000/smartsheet/webhook --sheet-id 123 --row-id 456
+        --secret ... [--row-id 789...] [--repeat 100 --interval 0.1] [--status DISABLED]
+
+Starts with the verification challenge, then posts row change callbacks,
+signed like SS does with --secret, the app's config.smartsheet_webhook_secret: it refuses callbacks without one.
+With several workers behind the url, every one of them should sync the rows, whichever got the callback.
+"""
+import hmac
+import json
+import time
+import uuid
+import hashlib
+import argparse
+import statistics
+
+import requests
+
+
+def post(url, payload, secret=None, headers=None):
+    body = json.dumps(payload).encode('utf-8')
+    headers = {'Content-Type': 'application/json', **(headers or {})}
+    if secret:
+        headers['Smartsheet-Hmac-SHA256'] = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+    return requests.post(url, data=body, headers=headers, timeout=10)
+
+
+def challenge(url):
+    token = uuid.uuid4().hex
+    reply = post(url, {'challenge': token, 'webhookId': 1}, headers={'Smartsheet-Hook-Challenge': token})
+    answered = reply.headers.get('Smartsheet-Hook-Response') == token
+    print(f'challenge: {reply.status_code}, answered {"correctly" if answered else "WRONG"}')
+
+
+def row_callback(sheet_id, row_ids):
+    return {'nonce': uuid.uuid4().hex,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'webhookId': 1,
+            'scope': 'sheet',
+            'scopeObjectId': sheet_id,
+            'events': [{'objectType': 'row', 'eventType': 'updated', 'id': row_id} for row_id in row_ids]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('url')
+    parser.add_argument('--sheet-id', type=int, required=True)
+    parser.add_argument('--row-id', type=int, action='append', default=[])
+    parser.add_argument('--secret', required=True)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--interval', type=float, default=0.5, help='seconds between two callbacks')
+    parser.add_argument('--status', help='post a newWebhookStatus callback instead, e.g. DISABLED/ENABLED')
+    options = parser.parse_args()
+
+    challenge(options.url)
+
+    if options.status:
+        reply = post(options.url, {'webhookId': 1, 'newWebhookStatus': options.status}, options.secret)
+        print(f'status {options.status}: {reply.status_code}')
+        return
+
+    seconds = []
+    for _ in range(options.repeat):
+        started_at = time.perf_counter()
+        reply = post(options.url, row_callback(options.sheet_id, options.row_id), options.secret)
+        seconds.append(time.perf_counter() - started_at)
+        if reply.status_code != 200:
+            print(f'callback refused: {reply.status_code} {reply.text[:200]}')
+        time.sleep(options.interval)
+
+    print(f'{len(seconds)} callbacks, median {statistics.median(seconds) * 1000:.1f} ms, '
+          f'max {max(seconds) * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Memory of the workflow per move, before and after the slotted WorkflowMove.
+
+    python benchmarks/workflow_memory.py [--rows 20000]
+
+Builds the workflow from generated SS rows both ways and reports the bytes allocated per move (tracemalloc):
+before, a WorkflowMove with a __dict__ per row, read from cell positions, the downloaded sheet kept alongside;
+after, the WorkflowSnapshot of slotted moves, interned values and the sheet dropped once converted.
+"""
+import os
+import gc
+import sys
+import argparse
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from workflow import CELL_FIELDS, WorkflowSnapshot, move_from_row  # noqa: E402
+
+CUSTOMERS = ('MAERSK', 'MSC', 'CMA CGM', 'HAPAG', 'ONE')
+LOCATIONS = ('TERMINAL A', 'TERMINAL B', 'YARD 1', 'YARD 2')
+STATUSES = ('LOADED', 'EMPTY')
+
+
+class DictWorkflowMove:
+    """WorkflowMove as it was, one __dict__ per row."""
+
+    def __init__(self, move_id, row_id, container_number, load_status, priority, customer, origin, destination, scac,
+                 truck_number, driver_id, ss_status, comments):
+        self.move_id = move_id
+        self.row_id = row_id
+        self.container_number = container_number
+        self.load_status = load_status
+        self.priority = priority
+        self.customer = customer
+        self.origin = origin
+        self.destination = destination
+        self.scac = scac
+        self.truck_number = truck_number
+        self.driver_id = driver_id
+        self.ss_status = ss_status
+        self.comments = comments
+
+
+def cell_value(field, index):
+    # SDK values are decoded from json, every row gets its own string objects
+    if field == 'move_id':
+        value = f'MV{index:08d}'
+    elif field == 'container_number':
+        value = f'MSCU{index:07d}'
+    elif field == 'customer':
+        value = CUSTOMERS[index % len(CUSTOMERS)]
+    elif field in ('origin', 'destination'):
+        value = LOCATIONS[(index + len(field)) % len(LOCATIONS)]
+    elif field == 'load_status':
+        value = STATUSES[index % 2]
+    elif field == 'priority':
+        value = str(index % 3)
+    elif field == 'scac':
+        value = 'ABCD' if index % 2 else None
+    elif field == 'driver_id':
+        value = f'AB-{index % 10000:04d}' if index % 3 == 0 else None
+    elif field == 'truck_number':
+        value = str(1000 + index % 500) if index % 3 == 0 else None
+    elif field == 'ss_status':
+        value = 'OPEN'
+    else:
+        value = None if index % 4 else 'call dispatch before pickup'
+    return None if value is None else ''.join(list(value))
+
+
+def downloaded_sheet(rows):
+    return SimpleNamespace(rows=[
+        SimpleNamespace(id=1_000_000 + index, modified_at=None,
+                        cells=[SimpleNamespace(column_id=column_id, display_value=cell_value(field, index))
+                               for column_id, field in enumerate(CELL_FIELDS)])
+        for index in range(rows)])
+
+
+def before(rows):
+    sheet = downloaded_sheet(rows)
+    workflow = {}
+    for i in sheet.rows:
+        workflow[i.cells[0].display_value] = DictWorkflowMove(i.cells[0].display_value, i.id,
+                                                              *(cell.display_value for cell in i.cells[1:12]))
+    return sheet, workflow  # the sheet stayed in a global next to the workflow
+
+
+def after(rows):
+    col_names = dict(enumerate(CELL_FIELDS))
+    moves = [move_from_row(row, col_names, 1) for row in downloaded_sheet(rows).rows]
+    return WorkflowSnapshot({1: 1}, {move.move_id: move for move in moves}, {move.row_id: move for move in moves})
+
+
+def measure(build, rows):
+    gc.collect()
+    tracemalloc.start()
+    kept = build(rows)
+    gc.collect()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return size, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20000)
+    options = parser.parse_args()
+
+    results = {name: measure(build, options.rows) for name, build in (('before', before), ('after', after))}
+    for name, (size, peak) in results.items():
+        print(f'{name:<7} {size / options.rows:8.0f} bytes/move kept   {peak / options.rows:8.0f} bytes/move peak   '
+              f'{size / 2 ** 20:7.1f} MiB for {options.rows} moves')
+    print(f'kept memory cut by {1 - results["after"][0] / results["before"][0]:.0%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import os
+import time
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class CarrierClient:
+    """
+    HTTP client for the carrier APIs.
+    Keeps one pooled keep-alive session per carrier, and every call has connect and read timeouts
+    so a slow carrier can't hang a worker.
+
+    :param carriers: {scac: base url}, base urls end with '/'
+    :param timeout: (connect, read) timeout in seconds
+    :param pool_sizes: {scac: max connections kept open}, for carriers that need more than default_pool_size
+    :param default_pool_size: max connections kept open to a carrier
+    :param driver_ttl: seconds a get_driver reply is reused
+    :param negative_driver_ttl: seconds a not found/suspended/not working get_driver reply is reused
+    :param on_request: called with the scac, endpoint (first segment of the path), status code
+                       ('error' if there was no reply) and seconds of every call
+    """
+
+    def __init__(self, carriers, timeout=(3.05, 10), pool_sizes=None, default_pool_size=10, driver_ttl=10,
+                 negative_driver_ttl=30, on_request=None):
+        self.carriers = carriers
+        self.timeout = timeout
+        self.pool_sizes = pool_sizes or {}
+        self.default_pool_size = default_pool_size
+        self.driver_ttl = driver_ttl
+        self.negative_driver_ttl = negative_driver_ttl
+        self.on_request = on_request
+
+        self.driver_cache_hits = 0
+        self.driver_cache_misses = 0
+        self._drivers = {}  # {(scac, shuttle_id): (expires_at, reply)}
+
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def session(self, scac):
+        """Session of a carrier, created on first use (and again after a fork, sockets can't be shared)."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._sessions = {}
+                self._pid = os.getpid()
+
+            session = self._sessions.get(scac)
+            if session is None:
+                pool_size = self.pool_sizes.get(scac, self.default_pool_size)
+                session = requests.Session()
+                session.mount(self.url(scac, ''), HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+                self._sessions[scac] = session
+
+            return session
+
+    def url(self, scac, path):
+        base_url = self.carriers.get(scac)
+        if not base_url:
+            raise requests.exceptions.InvalidURL(f'Carrier {scac} not found')
+        return f'{base_url}{path}'
+
+    def get(self, scac, path, **kwargs):
+        return self._request('GET', scac, path, **kwargs)
+
+    def post(self, scac, path, **kwargs):
+        return self._request('POST', scac, path, **kwargs)
+
+    def _request(self, method, scac, path, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        url = self.url(scac, path)
+
+        started_at = time.perf_counter()
+        status = 'error'
+        try:
+            reply = self.session(scac).request(method, url, **kwargs)
+            status = reply.status_code
+            return reply
+        finally:
+            if self.on_request is not None:
+                self.on_request(scac, path.split('/', 1)[0], status, time.perf_counter() - started_at)
+
+    def get_driver(self, scac, shuttle_id, use_cache=True):
+        """
+        get_driver reply of a carrier, cached for driver_ttl.
+        404/403/204 replies are cached too, other errors are not.
+
+        :param use_cache: False to skip the cache while notifications to the driver are still being delivered,
+                          the carrier doesn't know about them yet and its reply mustn't outlive them
+        """
+        key = (scac, shuttle_id)
+        now = time.monotonic()
+
+        if not use_cache:
+            self._drivers.pop(key, None)
+            self.driver_cache_misses += 1
+            return self.get(scac, f'get_driver/{shuttle_id}')
+
+        cached = self._drivers.get(key)
+        if cached is not None and cached[0] > now:
+            self.driver_cache_hits += 1
+            return cached[1]
+
+        self.driver_cache_misses += 1
+        reply = self.get(scac, f'get_driver/{shuttle_id}')
+
+        if reply.status_code == 200:
+            ttl = self.driver_ttl
+        elif reply.status_code in (204, 403, 404):
+            ttl = self.negative_driver_ttl
+        else:
+            return reply
+
+        if len(self._drivers) > 1024:
+            self._drivers = {driver: cached for driver, cached in self._drivers.items() if cached[0] > now}
+        self._drivers[key] = (now + ttl, reply)
+
+        return reply
+
+    def invalidate_driver(self, scac, shuttle_id):
+        """Forget the cached get_driver reply, to call once a move change of the driver reached the carrier."""
+        self._drivers.pop((scac, shuttle_id), None)
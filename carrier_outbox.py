@@ -0,0 +1,123 @@
+import os
+import json
+import uuid
+import logging
+from datetime import datetime, timedelta
+
+import requests
+from sqlalchemy import event, or_, select, update
+
+from utils import BackgroundWorker
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxWorker(BackgroundWorker):
+    """
+    Delivers carrier notifications from the outbox table in a background thread.
+
+    Handlers add notifications to the db session next to the OpenMoves change they announce,
+    so both are saved by the same commit and a notification survives a crash.
+    Each worker claims every pending notification of the drivers nobody else is working on,
+    so notifications of a driver are delivered in order, by a single process.
+
+    :param app: flask app, for the app context of the background thread
+    :param db: flask_sqlalchemy db
+    :param model: outbox model
+    :param carrier_client: CarrierClient
+    :param interval: seconds between two checks of the outbox when not woken by a commit
+    :param max_attempts: failed deliveries before a notification is set as FAILED
+    :param lease: seconds a worker keeps its claim on a driver
+    """
+
+    def __init__(self, app, db, model, carrier_client, interval=5, max_attempts=10, lease=60):
+        self.app = app
+        self.db = db
+        self.model = model
+        self.carrier_client = carrier_client
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.lease = lease
+        super().__init__('carrier-outbox', app)
+
+        self._process_token = None
+        self._token_pid = None
+
+        event.listen(db.session, 'after_commit', self._after_commit)
+
+    def add(self, scac, driver_id, path, data):
+        """Add a notification to the current db session, it is sent once the session is committed."""
+        self.db.session.add(self.model(scac, driver_id, path, json.dumps(data)))
+        self.db.session.info['carrier_outbox_pending'] = True
+
+    def has_pending(self, driver_id):
+        """True while notifications of a driver wait for delivery, whichever process queued them."""
+        model = self.model
+        return self.db.session.query(model.id).filter_by(status='PENDING', driver_id=driver_id).first() is not None
+
+    @property
+    def _token(self):
+        """Claims are per process, a forked worker gets its own token."""
+        if self._token_pid != os.getpid():
+            self._process_token = uuid.uuid4().hex
+            self._token_pid = os.getpid()
+        return self._process_token
+
+    def deliver(self):
+        """Claim pending notifications and send them, oldest first."""
+        model = self.model
+        now = datetime.now()
+
+        busy_drivers = select(model.driver_id).where(model.status == 'PENDING',
+                                                     or_(model.locked_until >= now, model.next_attempt_at > now))
+        self.db.session.execute(update(model)
+                                .where(model.status == 'PENDING', model.driver_id.notin_(busy_drivers))
+                                .values(locked_by=self._token, locked_until=now + timedelta(seconds=self.lease)))
+        self.db.session.commit()
+
+        claimed = model.query.filter_by(locked_by=self._token, status='PENDING').order_by(model.id).all()
+        failed_drivers = set()
+
+        for message in claimed:
+            if message.driver_id not in failed_drivers:
+                error = self._send(message)
+                if error is None:
+                    self.db.session.delete(message)
+                    self.db.session.commit()
+                    continue
+
+                failed_drivers.add(message.driver_id)
+                message.attempts += 1
+                message.last_error = error[:256]
+                if message.attempts >= self.max_attempts:
+                    message.status = 'FAILED'
+                    logger.error(f'Gave up on {message.path} to {message.scac} for {message.driver_id}: {error}')
+                else:
+                    message.next_attempt_at = datetime.now() + timedelta(seconds=min(2 ** message.attempts, 300))
+
+            message.locked_by = None
+            message.locked_until = None
+            self.db.session.commit()
+
+    def _send(self, message):
+        """Returns None once delivered, or why it wasn't."""
+        try:
+            reply = self.carrier_client.post(message.scac, message.path, json=json.loads(message.payload))
+        except requests.RequestException as e:
+            return str(e)
+
+        if reply.status_code >= 500:
+            return f'{reply.status_code} {reply.text}'
+
+        if reply.status_code >= 400:
+            logger.warning(f'{message.scac} refused {message.path} for {message.driver_id}: {reply.status_code}')
+
+        self.carrier_client.invalidate_driver(message.scac, message.driver_id)
+        return None
+
+    def _after_commit(self, session):
+        if session.info.pop('carrier_outbox_pending', False):
+            self.wake()
+
+    def _step(self):
+        self.deliver()
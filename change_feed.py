@@ -0,0 +1,268 @@
+import os
+import json
+import time
+import queue
+import logging
+import itertools
+import threading
+from datetime import datetime
+from collections import deque
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import object_session
+
+from utils import BackgroundWorker, LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+class _Subscriber:
+    def __init__(self, customers, locations, max_queue):
+        self.customers = set(customers)
+        self.locations = set(locations)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.overflowed = False
+
+    def matches(self, customers, locations):
+        return ((not self.customers or not self.customers.isdisjoint(customers))
+                and (not self.locations or not self.locations.isdisjoint(locations)))
+
+
+class ChangeFeed:
+    """
+    Fans change events out to server-sent event streams.
+
+    Every change carries the customers and locations it concerns, a stream filtered on some of them
+    only gets the changes matching them. Events are numbered and the latest ones kept,
+    so a client reconnecting with Last-Event-ID gets what it missed,
+    or a 'reset' event telling it to reload if they are gone or were published by another process.
+
+    :param history: events kept for reconnecting clients
+    :param max_queue: events waiting for a stream before it's sent a 'reset' instead
+    :param heartbeat: seconds between two keep-alive comments on an idle stream
+    :param retry: ms a disconnected client waits before reconnecting
+    """
+
+    def __init__(self, history=1000, max_queue=1000, heartbeat=15, retry=3000):
+        self.max_queue = max_queue
+        self.heartbeat = heartbeat
+        self.retry = retry
+
+        self._history = deque(maxlen=history)  # [(number, event, changes)]
+        self._numbers = itertools.count(1)
+        self._prefix = f'{os.getpid()}.{int(time.time())}'
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    @property
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def publish(self, event_name, changes):
+        """
+        :param event_name: SSE event name
+        :param changes: [(customers, locations, change)], change being a JSON serializable dict
+        """
+        if not changes:
+            return
+
+        with self._lock:
+            record = (next(self._numbers), event_name, changes)
+            self._history.append(record)
+            for subscriber in self._subscribers:
+                try:
+                    subscriber.queue.put_nowait(record)
+                except queue.Full:
+                    subscriber.overflowed = True
+
+    def stream(self, customers=(), locations=(), last_event_id=None):
+        """
+        Generator of SSE messages, runs until the client disconnects.
+
+        :param customers: only changes concerning one of these customers, all if empty
+        :param locations: only changes concerning one of these locations, all if empty
+        :param last_event_id: Last-Event-ID sent by a reconnecting client
+        """
+        subscriber = _Subscriber(customers, locations, self.max_queue)
+        with self._lock:
+            missed = self._missed(last_event_id)
+            self._subscribers.add(subscriber)
+
+        try:
+            yield f'retry: {self.retry}\n\n'
+
+            if missed is None:
+                yield self._reset()
+                missed = []
+
+            for record in missed:
+                message = self._message(subscriber, record)
+                if message:
+                    yield message
+
+            while True:
+                try:
+                    record = subscriber.queue.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+
+                if subscriber.overflowed:
+                    while not subscriber.queue.empty():
+                        subscriber.queue.get_nowait()
+                    subscriber.overflowed = False
+                    yield self._reset()
+                    continue
+
+                message = self._message(subscriber, record)
+                if message:
+                    yield message
+
+        finally:
+            with self._lock:
+                self._subscribers.discard(subscriber)
+
+    def _missed(self, last_event_id):
+        """Events published after last_event_id, None if they can't be told."""
+        if not last_event_id:
+            return []
+
+        prefix, _, number = last_event_id.rpartition('-')
+        if prefix != self._prefix or not number.isdigit():
+            return None
+
+        number = int(number)
+        if self._history and self._history[0][0] > number + 1:
+            return None
+
+        return [record for record in self._history if record[0] > number]
+
+    def _message(self, subscriber, record):
+        number, event_name, changes = record
+        matching = [change for customers, locations, change in changes if subscriber.matches(customers, locations)]
+        if not matching:
+            return None
+
+        data = json.dumps(matching, separators=(',', ':'), default=str)
+        return f'id: {self._prefix}-{number}\nevent: {event_name}\ndata: {data}\n\n'
+
+    def _reset(self):
+        with self._lock:
+            number = self._history[-1][0] if self._history else 0
+        return f'id: {self._prefix}-{number}\nevent: reset\ndata: {{}}\n\n'
+
+
+class RowWatcher(BackgroundWorker):
+    """
+    Reports rows of a table inserted, updated or deleted by any process, by polling modified_at from a background thread.
+    Commits of this process touching the table wake the thread right away.
+    Rows are reported along with their values last time they were seen, None if they weren't,
+    and deleted rows with None as their values. Deletes of this process are reported on commit,
+    those of other processes once the remembered rows are checked against the table.
+
+    :param app: flask app, for the app context of the background thread
+    :param db: flask_sqlalchemy db
+    :param model: watched model, with a modified_at column
+    :param columns: column names to report
+    :param on_change: called with [(previous values, values)] of the changed rows
+    :param interval: seconds between two polls
+    :param max_rows: rows whose values are remembered
+    :param delete_check_interval: seconds between two checks of the remembered rows still being in the table
+    """
+
+    def __init__(self, app, db, model, columns, on_change, interval=5, max_rows=10000, delete_check_interval=60):
+        self.app = app
+        self.db = db
+        self.model = model
+        self.columns = tuple(columns)
+        self.on_change = on_change
+        self.interval = interval
+        self.delete_check_interval = delete_check_interval
+        super().__init__('row-watcher', app, run_at_start=True)
+
+        self._seen = LRUCache(max_size=max_rows, ttl=86400)
+        self._since = None
+        self._deleted = set()  # ids of rows deleted by this process, not reported yet
+        self._deleted_lock = threading.Lock()
+        self._checked_deletes_at = time.monotonic()
+        self._session_key = f'row_watcher_{model.__tablename__}'  # several watchers share the session
+
+        event.listen(model, 'after_insert', self._mark)
+        event.listen(model, 'after_update', self._mark)
+        event.listen(model, 'after_delete', self._mark_deleted)
+        event.listen(db.session, 'after_commit', self._after_commit)
+        event.listen(db.session, 'after_rollback', self._after_rollback)
+
+    def poll(self):
+        """Report the rows modified or deleted since the last poll, the first one only remembers the latest rows."""
+        model = self.model
+        first_poll = self._since is None
+        if first_poll:
+            self._since = self.db.session.query(func.max(model.modified_at)).scalar()
+            if self._since is None:
+                self._since = datetime.min  # empty table, every row to come is new
+                return
+
+        with self._deleted_lock:
+            deleted, self._deleted = self._deleted, set()
+        if time.monotonic() - self._checked_deletes_at > self.delete_check_interval:
+            deleted.update(self._missing_rows())
+            self._checked_deletes_at = time.monotonic()
+
+        # modified_at has a resolution of a second, rows of the last second are read again and compared
+        rows = (self.db.session.query(model.id, model.modified_at, *[getattr(model, column) for column in self.columns])
+                .filter(model.modified_at >= self._since)
+                .order_by(model.modified_at))
+
+        changes = []
+        for row_id in deleted:
+            previous = self._seen.pop(row_id)
+            if previous is not None:  # rows never seen can't be told to the clients, their values are unknown
+                changes.append((previous, None))
+
+        for row in rows:
+            values = dict(zip(self.columns, row[2:]))
+            previous = self._seen.get(row.id)
+            if previous != values:
+                self._seen.put(row.id, values)
+                changes.append((previous, values))
+            self._since = max(self._since, row.modified_at)
+
+        if changes and not first_poll:
+            self.on_change(changes)
+
+    def _missing_rows(self):
+        """Remembered row ids no longer in the table, deleted by another process."""
+        model = self.model
+        row_ids = self._seen.keys()
+        missing = set()
+        for start in range(0, len(row_ids), 500):
+            chunk = row_ids[start:start + 500]
+            existing = {row_id for row_id, in self.db.session.query(model.id).filter(model.id.in_(chunk))}
+            missing.update(row_id for row_id in chunk if row_id not in existing)
+        return missing
+
+    def _mark(self, mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            session.info[self._session_key] = True
+
+    def _mark_deleted(self, mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault(f'{self._session_key}_deleted', set()).add(target.id)
+
+    def _after_commit(self, session):
+        deleted = session.info.pop(f'{self._session_key}_deleted', None)
+        if deleted:
+            with self._deleted_lock:
+                self._deleted.update(deleted)
+        if session.info.pop(self._session_key, False) or deleted:
+            self.wake()
+
+    def _after_rollback(self, session):
+        session.info.pop(self._session_key, None)
+        session.info.pop(f'{self._session_key}_deleted', None)
+
+    def _step(self):
+        self.poll()
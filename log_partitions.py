@@ -0,0 +1,208 @@
+import os
+import re
+import json
+import gzip
+import logging
+import threading
+from datetime import datetime
+
+from sqlalchemy import create_engine, func, select
+
+from utils import BackgroundWorker, Lease
+
+logger = logging.getLogger(__name__)
+
+PARTITION_FILE = re.compile(r'logs_(\d{4})_(\d{2})\.db')
+
+
+def month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+
+def next_month(month):
+    return datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+class LogPartitions(BackgroundWorker):
+    """
+    Monthly partitions of the log tables.
+
+    The log bind only keeps the current month, rotate() moves older records to one SQLite file per month
+    in small batches, so logs keep being written while it runs.
+    Partitions older than retention_months are exported to gzipped ndjson files and removed.
+    Records keep their ids when moved, so ids grow with time across partitions.
+
+    Every worker starts a rotation thread, a rotation first takes a lease on the single row of the state table,
+    so only one process moves records and writes exports at a time.
+
+    :param app: flask app, for the app context of the background thread
+    :param db: flask_sqlalchemy db
+    :param tables: log tables to partition
+    :param state_model: model with id, locked_by and locked_until columns, shared by every process
+    :param directory: where partitions and exports are kept
+    :param bind: bind key of the log tables
+    :param retention_months: months of partitions kept, older ones are exported
+    :param batch_size: records moved per transaction
+    :param interval: seconds between two rotations of the background thread
+    :param lease: seconds a rotation keeps its lease without finishing a batch
+    """
+
+    def __init__(self, app, db, tables, state_model, directory='log_partitions', bind='log', retention_months=12,
+                 batch_size=1000, interval=86400, lease=300):
+        self.app = app
+        self.db = db
+        self.tables = tables
+        self.state_model = state_model
+        self.directory = directory
+        self.bind = bind
+        self.retention_months = retention_months
+        self.batch_size = batch_size
+        self.interval = interval
+        super().__init__('log-partitions')
+
+        self._lease = Lease(db, state_model, seconds=lease)
+        self._engines = {}  # {month: engine}, also read by request threads
+        self._engines_lock = threading.Lock()
+
+    def months(self):
+        """Months with a partition file, oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+
+        months = []
+        for file_name in os.listdir(self.directory):
+            match = PARTITION_FILE.fullmatch(file_name)
+            if match:
+                months.append(datetime(int(match.group(1)), int(match.group(2)), 1))
+        return sorted(months)
+
+    def select(self, table, since=None, until=None, after_id=None, limit=None, **filters):
+        """
+        Records of a table from the partitions overlapping [since, until), oldest first.
+        Partitions are only read as the generator is consumed.
+
+        :param filters: {column name: value}
+        """
+        for month in self.months():
+            if since is not None and next_month(month) <= since:
+                continue
+            if until is not None and month >= until:
+                continue
+
+            query = select(table).order_by(table.c.id)
+            for name, value in filters.items():
+                query = query.where(table.c[name] == value)
+            if since is not None:
+                query = query.where(table.c.created_at >= since)
+            if until is not None:
+                query = query.where(table.c.created_at < until)
+            if after_id is not None:
+                query = query.where(table.c.id > after_id)
+            if limit is not None:
+                query = query.limit(limit)
+
+            with self._engine(month).connect() as connection:
+                yield from connection.execute(query)
+
+    def rotate(self):
+        """
+        Move records older than the current month to their partition, then expire old partitions.
+        Returns how many records were moved, None if another process is rotating.
+        """
+        with self.app.app_context():
+            if not self._lease.claim():
+                return None
+
+            try:
+                moved = self._move_records()
+                if moved is not None:
+                    self.expire()
+            finally:
+                self.db.session.rollback()
+                self._lease.release()
+            return moved
+
+    def _move_records(self):
+        live = self.db.engines[self.bind]
+        current_month = month_start(datetime.now())
+
+        total = 0
+        for table in self.tables:
+            moved = 0
+            while True:
+                with live.connect() as connection:
+                    # the newest record stays, or SQLite would reuse ids once the table is empty
+                    max_id = connection.execute(select(func.max(table.c.id))).scalar()
+                    if max_id is None:
+                        break
+                    records = connection.execute(select(table)
+                                                 .where(table.c.created_at < current_month, table.c.id < max_id)
+                                                 .order_by(table.c.id)
+                                                 .limit(self.batch_size)).mappings().all()
+                if not records:
+                    break
+
+                by_month = {}
+                for record in records:
+                    by_month.setdefault(month_start(record['created_at']), []).append(dict(record))
+
+                for month, month_records in by_month.items():
+                    with self._engine(month).begin() as connection:
+                        connection.execute(table.insert().prefix_with('OR REPLACE'), month_records)
+
+                with live.begin() as connection:
+                    connection.execute(table.delete().where(table.c.id.in_([record['id'] for record in records])))
+
+                moved += len(records)
+                if not self._lease.claim():
+                    logger.warning('Log rotation lost its lease, stopping')
+                    return None
+
+            logger.info(f'Moved {moved} {table.name} records to monthly partitions')
+            total += moved
+
+        return total
+
+    def expire(self):
+        """
+        Export partitions past retention_months to gzipped ndjson, one file per table, and remove them.
+        Only called by rotate(), under its lease.
+        """
+        oldest_kept = month_start(datetime.now())
+        for _ in range(self.retention_months):
+            oldest_kept = datetime(oldest_kept.year - (oldest_kept.month == 1), (oldest_kept.month - 2) % 12 + 1, 1)
+
+        for month in self.months():
+            if month >= oldest_kept:
+                continue
+
+            engine = self._engine(month)
+            for table in self.tables:
+                export_path = os.path.join(self.directory, 'exports', f'logs_{month:%Y_%m}_{table.name}.ndjson.gz')
+                os.makedirs(os.path.dirname(export_path), exist_ok=True)
+
+                with engine.connect() as connection, gzip.open(export_path, 'wt') as export:
+                    for record in connection.execute(select(table).order_by(table.c.id)).mappings():
+                        export.write(json.dumps(dict(record), default=str) + '\n')
+
+            with self._engines_lock:
+                self._engines.pop(month).dispose()
+                os.remove(self._path(month))
+            logger.info(f'Exported and removed the {month:%Y-%m} log partition')
+
+    def _path(self, month):
+        return os.path.join(self.directory, f'logs_{month:%Y_%m}.db')
+
+    def _engine(self, month):
+        with self._engines_lock:
+            engine = self._engines.get(month)
+            if engine is None:
+                os.makedirs(self.directory, exist_ok=True)
+                engine = create_engine(f'sqlite:///{self._path(month)}')
+                for table in self.tables:
+                    table.create(engine, checkfirst=True)
+                self._engines[month] = engine
+            return engine
+
+    def _step(self):
+        self.rotate()
@@ -0,0 +1,128 @@
+import bisect
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}  # {label values: count}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} counter'
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            yield f'{self.name}{_labels(self.labels, label_values)} {value}'
+
+
+class Histogram:
+    """Observations are counted in their bucket only, buckets are made cumulative when rendered."""
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # {label values: [bucket counts..., +Inf count, sum]}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *label_values):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            values = self._values.get(label_values)
+            if values is None:
+                values = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            values[index] += 1
+            values[-1] += seconds
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            values = [(label_values, list(counts)) for label_values, counts in self._values.items()]
+
+        for label_values, counts in values:
+            cumulated = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulated += count
+                yield f'{self.name}_bucket{_labels(self.labels, label_values, [("le", bound)])} {cumulated}'
+            yield f'{self.name}_sum{_labels(self.labels, label_values)} {counts[-1]}'
+            yield f'{self.name}_count{_labels(self.labels, label_values)} {cumulated}'
+
+
+class Callback:
+    """
+    Value read when metrics are rendered, for state kept elsewhere (sizes, counters of other objects...).
+
+    :param kind: 'gauge'/'counter'
+    :param function: returns a number, or {label values: number} if labels are given
+    """
+
+    def __init__(self, name, documentation, kind, function, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.function = function
+        self.labels = tuple(labels)
+
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.kind}'
+        values = self.function()
+        if not self.labels:
+            values = {(): values}
+        for label_values, value in values.items():
+            if value is not None:
+                yield f'{self.name}{_labels(self.labels, label_values)} {value}'
+
+
+class Registry:
+    """
+    Metrics of the process in the Prometheus text format.
+    Recording is a dict update under a lock, all the formatting happens when metrics are scraped.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labels=()):
+        return self._add(Counter(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, documentation, labels, buckets))
+
+    def callback(self, name, documentation, function, kind='gauge', labels=()):
+        return self._add(Callback(name, documentation, kind, function, labels))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
@@ -0,0 +1,206 @@
+import time
+import heapq
+import logging
+import itertools
+import threading
+
+logger = logging.getLogger(__name__)
+
+# priority classes, lower goes first
+GATE_WRITE = 0
+USER_READ = 1
+BACKGROUND_SYNC = 2
+
+PRIORITY_NAMES = {GATE_WRITE: 'gate_write', USER_READ: 'user_read', BACKGROUND_SYNC: 'background_sync'}
+
+RATE_LIMITED_ERROR = 4003  # SS error code sent along with a 429
+
+
+def is_rate_limited(reply):
+    """True for a 429 SS error, returned (SS models Error) or raised (ApiError)."""
+    result = getattr(getattr(reply, 'error', reply), 'result', None)
+    return getattr(result, 'status_code', None) == 429 or getattr(result, 'code', None) == RATE_LIMITED_ERROR
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every SS call of the process.
+    It only knows about its own process, with several worker processes give each one its part of the account's rate.
+    Callers waiting for a token are served by priority class, then in arrival order,
+    so gate writes never queue behind a backlog of background syncs.
+    A 429 empties the bucket and holds every call back, twice as long on every 429 in a row,
+    the SS client must not retry 429s itself (max_retry_time=0) or they would never get here.
+
+    :param rate: tokens added per second, SS allows 300 calls per minute and token, for all processes
+    :param burst: max tokens saved up while idle
+    :param backoff: seconds calls are held back after a first 429
+    :param max_backoff: max seconds calls are held back after 429s in a row
+    :param max_retries: times a call answered with a 429 is sent again
+    :param on_call: called with the operation (SDK method name), outcome ('ok'/'error'/'rate_limited')
+                    and seconds of every call sent, waits for a token excluded
+    """
+
+    def __init__(self, rate=4.5, burst=10, backoff=1, max_backoff=60, max_retries=3, on_call=None):
+        self.rate = rate
+        self.burst = burst
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_retries = max_retries
+        self.on_call = on_call
+
+        self.calls = 0
+        self.rate_limited = 0  # 429 replies
+        self.wait_seconds = dict.fromkeys(PRIORITY_NAMES.values(), 0.0)  # {priority name: seconds waited for tokens}
+        self.max_wait_seconds = dict.fromkeys(PRIORITY_NAMES.values(), 0.0)
+
+        self._tokens = burst
+        self._refilled_at = time.monotonic()
+        self._held_until = 0
+        self._penalties = 0  # 429s in a row
+        self._waiting = []  # heap of (priority, ticket)
+        self._tickets = itertools.count()
+        self._condition = threading.Condition()
+        self._thread_priority = threading.local()
+
+    def queue_depth(self):
+        """{priority name: callers waiting for a token}"""
+        with self._condition:
+            depth = dict.fromkeys(PRIORITY_NAMES.values(), 0)
+            for priority, ticket in self._waiting:
+                depth[PRIORITY_NAMES[priority]] += 1
+            return depth
+
+    def set_thread_priority(self, priority):
+        """Raise the priority of the calls made from this thread, e.g. USER_READ for request threads, None to reset."""
+        self._thread_priority.value = priority
+
+    def call(self, priority, function, *args, **kwargs):
+        """Call function once a token is available, and again after a 429."""
+        thread_priority = getattr(self._thread_priority, 'value', None)
+        if thread_priority is not None:
+            priority = min(priority, thread_priority)
+
+        for attempt in range(self.max_retries + 1):
+            self.acquire(priority)
+            started_at = time.perf_counter()
+            try:
+                reply = function(*args, **kwargs)
+            except Exception as error:
+                self._observe(function, error, started_at)
+                if not is_rate_limited(error) or attempt == self.max_retries:
+                    raise
+                self._penalize()
+                continue
+
+            self._observe(function, reply, started_at)
+            if not is_rate_limited(reply) or attempt == self.max_retries:
+                self._forgive()
+                return reply
+            self._penalize()
+
+        return reply
+
+    def acquire(self, priority):
+        """Wait for a token, returns the seconds waited."""
+        started_at = time.monotonic()
+        waiter = (priority, next(self._tickets))
+
+        with self._condition:
+            heapq.heappush(self._waiting, waiter)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+
+                    if self._waiting[0] != waiter:
+                        self._condition.wait()
+                        continue
+
+                    if now < self._held_until:
+                        self._condition.wait(self._held_until - now)
+                    elif self._tokens < 1:
+                        self._condition.wait((1 - self._tokens) / self.rate)
+                    else:
+                        heapq.heappop(self._waiting)
+                        self._tokens -= 1
+                        break
+            except BaseException:
+                self._waiting.remove(waiter)
+                heapq.heapify(self._waiting)
+                raise
+            finally:
+                self._condition.notify_all()
+
+            waited = time.monotonic() - started_at
+            self.calls += 1
+            name = PRIORITY_NAMES[priority]
+            self.wait_seconds[name] += waited
+            self.max_wait_seconds[name] = max(self.max_wait_seconds[name], waited)
+
+        return waited
+
+    def _observe(self, function, reply, started_at):
+        if self.on_call is None:
+            return
+
+        if is_rate_limited(reply):
+            outcome = 'rate_limited'
+        elif isinstance(reply, Exception) or type(reply).__name__ == 'Error':  # SS models Error, when not raised
+            outcome = 'error'
+        else:
+            outcome = 'ok'
+        self.on_call(getattr(function, '__name__', 'unknown'), outcome, time.perf_counter() - started_at)
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _penalize(self):
+        with self._condition:
+            self.rate_limited += 1
+            delay = min(self.backoff * 2 ** self._penalties, self.max_backoff)
+            self._penalties += 1
+            self._tokens = 0
+            self._held_until = max(self._held_until, time.monotonic() + delay)
+            self._condition.notify_all()
+        logger.warning('SS rate limit hit, holding calls back for %s s', delay)
+
+    def _forgive(self):
+        if self._penalties:
+            with self._condition:
+                self._penalties = 0
+
+
+class LimitedClient:
+    """
+    SS client whose API calls (client.Sheets.get_sheet(...)...) go through a RateLimiter.
+
+    :param client: smartsheet client
+    :param limiter: RateLimiter
+    :param priority: priority class of the calls
+    """
+
+    def __init__(self, client, limiter, priority):
+        self._client = client
+        self._limiter = limiter
+        self._priority = priority
+
+    def __getattr__(self, name):
+        return _LimitedSection(getattr(self._client, name), self._limiter, self._priority)
+
+
+class _LimitedSection:
+    def __init__(self, section, limiter, priority):
+        self._section = section
+        self._limiter = limiter
+        self._priority = priority
+
+    def __getattr__(self, name):
+        method = getattr(self._section, name)
+        if not callable(method):
+            return method
+
+        def limited_call(*args, **kwargs):
+            return self._limiter.call(self._priority, method, *args, **kwargs)
+
+        return limited_call
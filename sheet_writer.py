@@ -0,0 +1,159 @@
+import logging
+import threading
+
+from utils import BackgroundWorker
+
+logger = logging.getLogger(__name__)
+
+ROW_NOT_FOUND = 1006  # SS error code of an update on a deleted row
+
+
+def smartsheet_models():
+    """The SDK takes a while to import, only load it once something is written."""
+    import smartsheet
+    return smartsheet.models
+
+
+class RowWriteQueue(BackgroundWorker):
+    """
+    Write-behind queue for SS row updates.
+    Pending cell updates are coalesced per row (last write wins per column)
+    and sent in batched update_rows calls from a background thread.
+
+    :param ss_client: smartsheet client
+    :param sheet_id: sheet the rows belong to
+    :param flush_interval: seconds between two flushes of the background thread
+    :param batch_size: max rows per update_rows call, reaching it wakes the background thread early
+    :param on_flush: called after every flush that wrote something, e.g. to resync the workflow
+    """
+
+    def __init__(self, ss_client, sheet_id, flush_interval=1.0, batch_size=100, on_flush=None):
+        self.ss_client = ss_client
+        self.sheet_id = sheet_id
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        super().__init__('row-write-queue')
+
+        self._pending = {}  # {row_id: {column_id: value}}
+        self._in_flight = {}  # {row_id: {column_id: value}} being sent by a flush
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def put(self, row_id, cells, wait=False):
+        """
+        Queue cell updates of a row.
+
+        :param row_id: row to update
+        :param cells: {column_id: new value}
+        :param wait: True to flush and wait for SS, for flows that need to read their writes
+        :return: row ids SS refused to update if waited, else None
+        """
+        self.start()
+
+        with self._lock:
+            self._pending.setdefault(row_id, {}).update(cells)
+            full = len(self._pending) >= self.batch_size
+
+        if wait:
+            return self.flush()
+
+        if full:
+            self.wake()
+
+    def pending(self):
+        """{row_id: {column_id: value}} of the updates SS hasn't acknowledged yet, queued or being sent."""
+        with self._lock:
+            pending = {row_id: dict(cells) for row_id, cells in self._in_flight.items()}
+            for row_id, cells in self._pending.items():
+                pending.setdefault(row_id, {}).update(cells)
+            return pending
+
+    def flush(self):
+        """
+        Send every pending update and wait for SS to answer.
+        Batches that fail as a whole with a retryable error are queued again.
+
+        :return: row ids SS refused to update
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._in_flight = pending
+
+            if not pending:
+                return []
+
+            try:
+                failed_row_ids = self._send(pending)
+            finally:
+                with self._lock:
+                    self._in_flight = {}
+
+            if self.on_flush is not None:
+                self.on_flush()
+
+            return failed_row_ids
+
+    def _send(self, pending):
+        """Send pending updates in batches, returns the row ids SS refused to update."""
+        failed_row_ids = []
+        pending = list(pending.items())
+
+        for start in range(0, len(pending), self.batch_size):
+            batch = pending[start:start + self.batch_size]
+            try:
+                result = self.ss_client.Sheets.update_rows_with_partial_success(
+                    self.sheet_id,
+                    [self._new_row(row_id, cells) for row_id, cells in batch]
+                )
+            except Exception:
+                logger.exception('Update of %d rows failed, queued again', len(batch))
+                self._requeue(batch)
+                continue
+
+            if isinstance(result, smartsheet_models().Error):
+                if result.result.should_retry:
+                    logger.warning('Update of %d rows failed, queued again: %s', len(batch), result.result.message)
+                    self._requeue(batch)
+                else:
+                    logger.error('Update of %d rows failed: %s', len(batch), result.result.message)
+                    failed_row_ids.extend(row_id for row_id, cells in batch)
+                continue
+
+            for failed_item in result.failed_items or []:
+                if failed_item.error.code == ROW_NOT_FOUND:
+                    logger.warning('Row %s was deleted from the sheet before its update', failed_item.row_id)
+                else:
+                    logger.error('Update of row %s failed: %s', failed_item.row_id, failed_item.error.message)
+                failed_row_ids.append(failed_item.row_id)
+
+        return failed_row_ids
+
+    def _requeue(self, batch):
+        """Put a failed batch back, without overwriting values queued since."""
+        with self._lock:
+            for row_id, cells in batch:
+                cells = dict(cells)
+                cells.update(self._pending.get(row_id, {}))
+                self._pending[row_id] = cells
+
+    def _interval(self):
+        return self.flush_interval
+
+    def _step(self):
+        self.flush()
+
+    @staticmethod
+    def _new_row(row_id, cells):
+        models = smartsheet_models()
+        new_row = models.Row()
+        new_row.id = row_id
+
+        for column_id, value in cells.items():
+            new_cell = models.Cell()
+            new_cell.column_id = column_id
+            new_cell.value = value
+            new_row.cells.append(new_cell)
+
+        return new_row
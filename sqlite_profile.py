@@ -0,0 +1,46 @@
+from functools import partial
+
+from sqlalchemy import event
+
+# WAL lets readers work while a writer commits, synchronous=NORMAL is durable enough with WAL
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,  # ms
+    'cache_size': -16000,  # KiB
+    'mmap_size': 134217728,  # bytes
+    'temp_store': 'MEMORY',
+}
+
+
+def apply_sqlite_profile(db, pragmas=None):
+    """
+    Set pragmas on every new connection of every SQLite bind, call within an app context before connecting.
+
+    :param db: flask_sqlalchemy db
+    :param pragmas: {bind key: {pragma: value}} overriding DEFAULT_PRAGMAS, None is the key of the default bind
+    """
+    pragmas = pragmas or {}
+
+    for bind, engine in db.engines.items():
+        if engine.dialect.name != 'sqlite':
+            continue
+
+        bind_pragmas = dict(DEFAULT_PRAGMAS)
+        bind_pragmas.update(pragmas.get(bind, {}))
+        event.listen(engine, 'connect', partial(_set_pragmas, bind_pragmas))
+
+
+def create_missing_indexes(db):
+    """create_all() skips tables that already exist, and with them the indexes added to their models since."""
+    for bind, engine in db.engines.items():
+        for table in db.metadatas[bind].tables.values():
+            for index in table.indexes:
+                index.create(bind=engine, checkfirst=True)
+
+
+def _set_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
@@ -0,0 +1,88 @@
+import os
+import sys
+from datetime import datetime
+
+import pytest
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from archive import MoveArchiver  # noqa: E402
+
+
+@pytest.fixture
+def archiver(tmp_path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{tmp_path / "database.db"}'
+    app.config['SQLALCHEMY_BINDS'] = {'completed_moves': f'sqlite:///{tmp_path / "completed_moves.db"}'}
+    db = SQLAlchemy(app)
+
+    class OpenMoves(db.Model):
+        __tablename__ = 'open_moves'
+        id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+        move_id = db.Column(db.String(24))
+        driver_id = db.Column(db.String(16))
+        status = db.Column(db.String(32))
+        created_at = db.Column(db.DateTime)
+        modified_at = db.Column(db.DateTime)
+
+    class CompletedMoves(db.Model):
+        __bind_key__ = 'completed_moves'
+        __tablename__ = 'completed_moves'
+        id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+        move_id = db.Column(db.String(24))
+        driver_id = db.Column(db.String(16))
+        status = db.Column(db.String(32))
+        created_at = db.Column(db.DateTime)
+        modified_at = db.Column(db.DateTime)
+
+    class ArchiveState(db.Model):
+        __tablename__ = 'archive_state'
+        id = db.Column(db.Integer, primary_key=True)
+        high_water_mark = db.Column(db.Integer, default=0)
+        locked_by = db.Column(db.String(32), nullable=True)
+        locked_until = db.Column(db.DateTime, nullable=True)
+
+    with app.app_context():
+        db.create_all()
+        now = datetime.now()
+        db.session.add_all([OpenMoves(move_id=f'MV{index:08d}', driver_id='AB-0001', created_at=now, modified_at=now,
+                                      status='DELIVERED' if index % 3 else 'OTW')
+                            for index in range(1, 11)])
+        db.session.commit()
+
+        yield MoveArchiver(app, db, OpenMoves, CompletedMoves, ArchiveState, batch_size=2, pause=0)
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+def test_run_archives_every_batch(archiver):
+    assert archiver.run() == 7
+    assert archiver.last_run_moved == 7
+
+    assert sorted(move.status for move in archiver.open_model.query) == ['OTW'] * 3
+    assert archiver.completed_model.query.count() == 7
+    assert {move.move_id for move in archiver.completed_model.query} == {f'MV{index:08d}' for index in range(1, 11)
+                                                                         if index % 3}
+
+    state = archiver.db.session.get(archiver.state_model, 1)
+    assert (state.high_water_mark, state.locked_by, state.locked_until) == (0, None, None)
+
+
+def test_run_resumes_from_the_high_water_mark(archiver):
+    archiver._claim()
+    archiver._release(5)
+
+    assert archiver.run() == 3  # moves 7, 8 and 10
+    assert archiver.open_model.query.count() == 7
+    assert archiver.db.session.get(archiver.state_model, 1).high_water_mark == 0
+
+
+def test_run_leaves_a_leased_state_alone(archiver):
+    other = MoveArchiver(archiver.app, archiver.db, archiver.open_model, archiver.completed_model,
+                         archiver.state_model)
+    assert other._claim()
+
+    assert archiver.run() is None
+    assert archiver.open_model.query.count() == 10
@@ -1,27 +1,272 @@
 import os
+import hmac
+import time
+import uuid
+import logging
 import hashlib
 import binascii
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, update
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+# hashes are stored as b'pbkdf2_sha512$<iterations>$<salt>$<hash>',
+# older ones as b'<salt><hash>' with LEGACY_ITERATIONS
+HASH_PREFIX = b'pbkdf2_sha512$'
+LEGACY_ITERATIONS = 100000
+
+password_iterations = LEGACY_ITERATIONS
+
+_pool = None
+_pool_pid = None
+_pool_workers = 2
+_pool_slots = threading.BoundedSemaphore(8)
+_pool_lock = threading.Lock()
+
+
+def configure_password_hashing(iterations=LEGACY_ITERATIONS, workers=2, max_pending=8):
+    """
+    :param iterations: PBKDF2 iterations of new hashes, hashes with another count are upgraded on login
+    :param workers: processes hashing passwords
+    :param max_pending: hashes queued or running at once, further requests wait for a slot
+    """
+    global password_iterations, _pool_workers, _pool_slots
+    password_iterations = iterations
+    _pool_workers = workers
+    _pool_slots = threading.BoundedSemaphore(max_pending)
+
+
+def _pbkdf2(password, salt, iterations):
+    return binascii.hexlify(hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'), salt, iterations))
+
+
+def _run_in_pool(password, salt, iterations):
+    """Hash in the process pool, so request threads don't compete for the GIL with it."""
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=_pool_workers, mp_context=multiprocessing.get_context('spawn'))
+            _pool_pid = os.getpid()
+        pool = _pool
+
+    with _pool_slots:
+        return pool.submit(_pbkdf2, password, salt, iterations).result()
 
 
 def hash_pass(password):
     """Hash a password for storing."""
 
     salt = hashlib.sha256(os.urandom(60)).hexdigest().encode('ascii')
-    powered_hash = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'),
-                                       salt, 100000)
-    powered_hash = binascii.hexlify(powered_hash)
-    return salt + powered_hash  # return bytes
+    powered_hash = _run_in_pool(password, salt, password_iterations)
+    return HASH_PREFIX + str(password_iterations).encode('ascii') + b'$' + salt + b'$' + powered_hash  # return bytes
+
+
+def _parse_hash(stored_password):
+    """Returns iterations, salt and hash of a stored password."""
+    if stored_password.startswith(HASH_PREFIX):
+        iterations, salt, powered_hash = stored_password[len(HASH_PREFIX):].split(b'$')
+        return int(iterations), salt, powered_hash
+
+    return LEGACY_ITERATIONS, stored_password[:64], stored_password[64:]
 
 
 def verify_pass(provided_password, stored_password):
     """Verify a stored password against one provided by user"""
 
-    stored_password = stored_password.decode('ascii')
-    salt = stored_password[:64]
-    stored_password = stored_password[64:]
-    powered_hash = hashlib.pbkdf2_hmac('sha512',
-                                       provided_password.encode('utf-8'),
-                                       salt.encode('ascii'),
-                                       100000)
-    powered_hash = binascii.hexlify(powered_hash).decode('ascii')
-    return powered_hash == stored_password
+    iterations, salt, stored_hash = _parse_hash(stored_password)
+    powered_hash = _run_in_pool(provided_password, salt, iterations)
+    return hmac.compare_digest(powered_hash, stored_hash)
+
+
+def needs_rehash(stored_password):
+    """True if a stored password isn't hashed with the current format and iteration count."""
+    iterations, salt, stored_hash = _parse_hash(stored_password)
+    return not stored_password.startswith(HASH_PREFIX) or iterations != password_iterations
+
+
+class LRUCache:
+    """Thread safe least recently used cache, entries also expire after ttl seconds."""
+
+    def __init__(self, max_size=256, ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # {key: (expires_at, value)}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        """Remove an entry, returns its value if it was there and not expired."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    def keys(self):
+        """Keys of the entries, from least to most recently used."""
+        with self._lock:
+            return list(self._entries)
+
+
+class Lazy:
+    """
+    Proxy building its object on first use, and again in a forked process,
+    so importing a module doesn't pay for its clients.
+
+    :param factory: called without arguments to build the object
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._instance = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._instance is None or self._pid != os.getpid():
+                self._instance = self._factory()
+                self._pid = os.getpid()
+            return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+class BackgroundWorker:
+    """
+    Base of the classes doing their work from a background thread: subclasses implement _step(),
+    run every _interval() seconds, or right away once wake() is called.
+
+    :param name: name of the thread, also used in the log of failed steps
+    :param app: flask app, _step() runs in its app context if given
+    :param run_at_start: True to run a first step as soon as the thread starts
+    """
+
+    def __init__(self, name, app=None, run_at_start=False):
+        self._name = name
+        self._app = app
+        self._run_at_start = run_at_start
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """Start the background thread, once per process (it doesn't survive a fork)."""
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+
+        self._pid = os.getpid()
+        if self._run_at_start:
+            self._wake.set()
+        self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        """Run the next step now."""
+        self._wake.set()
+
+    def _interval(self):
+        """Seconds until the next step."""
+        return self.interval
+
+    def _step(self):
+        raise NotImplementedError
+
+    def _run(self):
+        while True:
+            self._wake.wait(self._interval())
+            self._wake.clear()
+            try:
+                if self._app is None:
+                    self._step()
+                else:
+                    with self._app.app_context():
+                        self._step()
+            except Exception:
+                logger.exception('Background %s failed', self._name)
+
+
+class Lease:
+    """
+    Lease on a row of a state table, so a job run by every worker process runs in one at a time.
+    The row is created by the first claim, a lease not renewed within seconds can be taken by another process.
+
+    :param db: flask_sqlalchemy db
+    :param model: model with id, locked_by and locked_until columns
+    :param row_id: id of the row
+    :param seconds: how long a claim holds the lease
+    """
+
+    def __init__(self, db, model, row_id=1, seconds=300):
+        self.db = db
+        self.model = model
+        self.row_id = row_id
+        self.seconds = seconds
+        self._token = None
+        self._pid = None
+
+    @property
+    def token(self):
+        """Token of this process, a forked process gets its own."""
+        if self._pid != os.getpid():
+            self._token = uuid.uuid4().hex
+            self._pid = os.getpid()
+        return self._token
+
+    def held(self):
+        """Condition on the row being leased by this process, for updates made under the lease."""
+        return (self.model.id == self.row_id) & (self.model.locked_by == self.token)
+
+    def claim(self):
+        """Take or renew the lease, False if another process holds it."""
+        model = self.model
+        if self.db.session.get(model, self.row_id) is None:
+            self.db.session.add(model(id=self.row_id))
+            try:
+                self.db.session.commit()
+            except IntegrityError:
+                self.db.session.rollback()  # created by another process meanwhile
+
+        now = datetime.now()
+        claimed = self.db.session.execute(
+            update(model)
+            .where(model.id == self.row_id,
+                   or_(model.locked_by == self.token, model.locked_until.is_(None), model.locked_until < now))
+            .values(locked_by=self.token, locked_until=now + timedelta(seconds=self.seconds))
+        ).rowcount
+        self.db.session.commit()
+        return claimed == 1
+
+    def release(self, **values):
+        """Give the lease up, setting other columns of the row along."""
+        self.db.session.execute(update(self.model)
+                                .where(self.held())
+                                .values(locked_by=None, locked_until=None, **values))
+        self.db.session.commit()
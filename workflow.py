@@ -0,0 +1,582 @@
+import os
+import sys
+import copy
+import time
+import pickle
+import logging
+import threading
+from types import MappingProxyType
+
+from utils import BackgroundWorker
+
+logger = logging.getLogger(__name__)
+
+
+# WorkflowMove fields read from the sheet, in the order of config.col_id_filter and of the columns, see check_columns
+CELL_FIELDS = ('move_id', 'container_number', 'load_status', 'priority', 'customer', 'origin', 'destination', 'scac',
+               'truck_number', 'driver_id', 'ss_status', 'comments')
+
+# bumped whenever the layout of saved snapshots changes, older files are ignored
+SNAPSHOT_FILE_FORMAT = 2
+
+# fields with a handful of distinct values across the sheet, interned to share one string per value
+_LOW_CARDINALITY_FIELDS = ('load_status', 'priority', 'customer', 'origin', 'destination', 'scac', 'ss_status')
+
+
+class WorkflowMove:
+    """
+    A row of the open move log.
+    Slotted, so large sheets don't pay for a __dict__ per row,
+    and indexable in the field order of the sheet (move[0] is the move id, move[1] the row id...).
+    sheet_id is the sheet the row belongs to, last so indexes stay the same.
+    """
+
+    __slots__ = ('move_id', 'row_id', 'container_number', 'load_status', 'priority', 'customer', 'origin',
+                 'destination', 'scac', 'truck_number', 'driver_id', 'ss_status', 'comments', 'sheet_id')
+
+    def __init__(self, move_id, row_id, container_number, load_status, priority, customer, origin, destination, scac,
+                 truck_number, driver_id, ss_status, comments, sheet_id=None):
+        self.move_id = move_id
+        self.row_id = row_id
+        self.container_number = container_number
+        self.load_status = load_status
+        self.priority = priority
+        self.customer = customer
+        self.origin = origin
+        self.destination = destination
+        self.scac = scac
+        self.truck_number = truck_number
+        self.driver_id = driver_id
+        self.ss_status = ss_status
+        self.comments = comments
+        self.sheet_id = sheet_id
+
+    def __repr__(self):
+        return self.move_id
+
+    def __getitem__(self, index):
+        return getattr(self, self.__slots__[index])
+
+    def replace(self, **fields):
+        """Copy of the move with some fields changed, moves inside a snapshot are never modified."""
+        move = copy.copy(self)
+        for field, value in fields.items():
+            setattr(move, field, value)
+        return move
+
+
+def _values(move):
+    return tuple(getattr(move, field) for field in WorkflowMove.__slots__)
+
+
+def move_from_row(row, col_names, sheet_id=None):
+    """
+    Build a WorkflowMove from a SS row, matching cells by column id rather than position.
+
+    :param row: smartsheet row
+    :param col_names: {column_id: WorkflowMove field}
+    :param sheet_id: sheet the row was read from
+    """
+    values = dict.fromkeys(CELL_FIELDS)
+    for cell in row.cells:
+        field = col_names.get(cell.column_id)
+        if field is not None:
+            values[field] = cell.display_value
+
+    for field in _LOW_CARDINALITY_FIELDS:
+        if values[field] is not None:
+            values[field] = sys.intern(values[field])
+
+    return WorkflowMove(row_id=row.id, sheet_id=sheet_id, **values)
+
+
+def check_columns(sheet, col_names, sheet_id=None):
+    """
+    Make sure the configured columns still match a downloaded sheet, raises ValueError if not.
+    Fields are configured by position (config.col_id_filter in the order of CELL_FIELDS),
+    which has to be the order of the columns in the sheet.
+
+    :param sheet: smartsheet sheet downloaded with column_ids=list(col_names)
+    :param col_names: {column_id: WorkflowMove field}
+    """
+    titles = {column.id: column.title for column in sheet.columns}
+
+    missing = [column_id for column_id in col_names if column_id not in titles]
+    if missing:
+        raise ValueError(f'Columns {missing} of the open move log {sheet_id} are gone, check config.col_id_filter')
+
+    sheet_order = [column.id for column in sheet.columns if column.id in col_names]
+    if sheet_order != list(col_names):
+        mapping = ', '.join(f'{titles[column_id]!r} -> {field}' for column_id, field in col_names.items())
+        raise ValueError(f'Columns of the open move log {sheet_id} are not in the order of config.col_id_filter, '
+                         f'refusing to read them as {mapping}')
+
+
+class WorkflowSnapshot:
+    """
+    Read-only view of the open move log sheets at given sheet versions, merged into one index.
+    A new snapshot is published on every sync, request handlers only ever read it.
+
+    Moves not assigned to a driver yet are indexed by (customer, origin, scac),
+    scac is None for moves no carrier has taken yet.
+
+    :param versions: {sheet_id: sheet version} the snapshot was built from
+    :param moves: {'Unique Move ID': WorkflowMove}, across sheets
+    :param rows: {row_id: WorkflowMove}, every row of the sheets including duplicated move ids
+    :param candidates: {(customer, origin, scac): (move_id, ...)}, built from moves if not given
+    """
+
+    def __init__(self, versions, moves, rows, candidates=None):
+        self.versions = MappingProxyType(versions)
+        self.moves = MappingProxyType(moves)
+        self.rows = MappingProxyType(rows)
+
+        if candidates is None:
+            candidates = {}
+            for move in moves.values():
+                if not move.driver_id:
+                    candidates.setdefault((move.customer, move.origin, move.scac), []).append(move.move_id)
+            candidates = {key: tuple(move_ids) for key, move_ids in candidates.items()}
+
+        self._candidates = candidates
+
+    def get(self, move_id, default=None):
+        return self.moves.get(move_id, default)
+
+    def values(self):
+        return self.moves.values()
+
+    def __contains__(self, move_id):
+        return move_id in self.moves
+
+    def __len__(self):
+        return len(self.moves)
+
+    def sheet_row_ids(self, sheet_id):
+        """Ids of the rows read from a sheet."""
+        return {row_id for row_id, move in self.rows.items() if move.sheet_id == sheet_id}
+
+    def changes(self, previous):
+        """(previous move, move) of every move id whose move differs from the previous snapshot, None if absent."""
+        for move_id, move in self.moves.items():
+            previous_move = previous.moves.get(move_id)
+            if previous_move is not move and (previous_move is None or _values(previous_move) != _values(move)):
+                yield previous_move, move
+
+        for move_id, previous_move in previous.moves.items():
+            if move_id not in self.moves:
+                yield previous_move, None
+
+    def candidates(self, customer, origin, scac):
+        """Ids of moves free to assign for a customer leaving from origin."""
+        return self._candidates.get((customer, origin, scac), ())
+
+    def replace(self, versions, new_moves=(), dropped_row_ids=()):
+        """
+        New snapshot with rows dropped and moves inserted or updated.
+        Only the index entries of the affected moves are touched.
+
+        :param versions: {sheet_id: sheet version} of the new snapshot
+        :param new_moves: WorkflowMove to insert, or to update if its row_id already exists
+        :param dropped_row_ids: row ids deleted from the sheet
+        """
+        moves, rows, candidates = dict(self.moves), dict(self.rows), dict(self._candidates)
+
+        for row_id in dropped_row_ids:
+            self._drop_row(moves, rows, candidates, row_id)
+
+        for move in new_moves:
+            self._drop_row(moves, rows, candidates, move.row_id)
+
+            shadowed_move = moves.get(move.move_id)
+            if shadowed_move is not None:
+                self._drop_candidate(candidates, shadowed_move)
+
+            rows[move.row_id] = move
+            moves[move.move_id] = move
+            if not move.driver_id:
+                key = (move.customer, move.origin, move.scac)
+                candidates[key] = candidates.get(key, ()) + (move.move_id,)
+
+        return WorkflowSnapshot(dict(versions), moves, rows, candidates)
+
+    @classmethod
+    def _drop_row(cls, moves, rows, candidates, row_id):
+        old_move = rows.pop(row_id, None)
+        if old_move is not None and moves.get(old_move.move_id) is old_move:
+            del moves[old_move.move_id]
+            cls._drop_candidate(candidates, old_move)
+
+    @staticmethod
+    def _drop_candidate(candidates, move):
+        if move.driver_id:
+            return
+
+        key = (move.customer, move.origin, move.scac)
+        move_ids = tuple(move_id for move_id in candidates.get(key, ()) if move_id != move.move_id)
+        if move_ids:
+            candidates[key] = move_ids
+        else:
+            candidates.pop(key, None)
+
+
+class WorkflowSync(BackgroundWorker):
+    """
+    Keeps a WorkflowSnapshot of the SS open move log sheets up to date from a background thread.
+
+    Every sheet has its own version, and only sheets whose version changed are downloaded,
+    their rows replacing the ones previously read from the same sheet in the merged snapshot.
+
+    :param ss_client: smartsheet client
+    :param sheets: {sheet_id: {column_id: WorkflowMove field}}, only these columns are downloaded
+    :param interval: seconds between two version checks of the background thread
+    :param max_staleness: seconds a snapshot may go unchecked before a reader syncs it inline
+    :param incremental: True to only download rows modified since the last sync
+    :param on_publish: called with the previous and the new snapshot whenever one is published
+    :param webhook_active: True when a SS webhook reports changes, polling then slows down to fallback_interval
+    :param fallback_interval: seconds between two version checks while webhook_active
+    :param max_targeted_rows: dirty rows of a sheet above which a targeted sync falls back to a delta sync
+    :param snapshot_path: file the snapshot is saved to after every sync, and loaded from by load()
+    :param pending_fields: called with a sheet id, returns {row_id: {WorkflowMove field: value}} of the writes
+                           not in SS yet, laid over the rows of every sync so they don't flicker back
+    """
+
+    def __init__(self, ss_client, sheets, interval=15, max_staleness=60, incremental=True, on_publish=None,
+                 webhook_active=False, fallback_interval=300, max_targeted_rows=500, snapshot_path=None,
+                 pending_fields=None):
+        self.ss_client = ss_client
+        self.sheets = sheets
+        self.interval = interval
+        self.max_staleness = max_staleness
+        self.incremental = incremental
+        self.on_publish = on_publish
+        self.webhook_active = webhook_active
+        self.fallback_interval = fallback_interval
+        self.max_targeted_rows = max_targeted_rows
+        self.snapshot_path = snapshot_path
+        self.pending_fields = pending_fields
+        super().__init__('workflow-sync')
+
+        self.last_sync = {'mode': None, 'sheet_id': None, 'rows_touched': 0}  # rows changed by the last sync
+        self.rows_touched_total = 0
+        self._modified_since = {}  # {sheet_id: datetime}
+        self._dirty_row_ids = {}  # {sheet_id: {row_id}}
+        self._changed_sheets = set()
+        self._dirty_lock = threading.Lock()
+
+        self._snapshot = WorkflowSnapshot({}, {}, {})
+        self._checked_at = None
+        self._local_updates = {}  # {row_id: fields} applied by update_move since the running sync started
+        self._sync_lock = threading.Lock()  # one sync at a time, held across downloads
+        self._publish_lock = threading.Lock()  # held only to swap the published snapshot
+
+    def load(self):
+        """
+        Start from the snapshot saved by the last sync, keeping the sheets still configured with the same columns.
+        It's served right away, and reconciled with the sheets as soon as the background thread starts.
+        Returns True if a snapshot was loaded.
+        """
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+
+        started_at = time.perf_counter()
+        try:
+            with open(self.snapshot_path, 'rb') as snapshot_file:
+                file_format, sheets, versions, modified_since, rows, move_row_ids = pickle.load(snapshot_file)
+        except Exception:
+            logger.exception('Unreadable workflow snapshot file, ignored')
+            return False
+
+        if file_format != SNAPSHOT_FILE_FORMAT:
+            logger.info('Workflow snapshot file is from another format, ignored')
+            return False
+
+        kept_sheets = {sheet_id for sheet_id, col_names in sheets.items() if self.sheets.get(sheet_id) == col_names}
+        if not kept_sheets:
+            logger.info('Workflow snapshot file is from other sheets, ignored')
+            return False
+
+        # interned values were pickled once and are still shared between moves
+        rows = {values[1]: WorkflowMove(*values) for values in rows if values[-1] in kept_sheets}
+        moves = {rows[row_id].move_id: rows[row_id] for row_id in move_row_ids if row_id in rows}
+        versions = {sheet_id: version for sheet_id, version in versions.items() if sheet_id in kept_sheets}
+
+        with self._sync_lock:
+            self._modified_since = {sheet_id: moment for sheet_id, moment in modified_since.items()
+                                    if sheet_id in kept_sheets}
+            self._set_snapshot(WorkflowSnapshot(versions, moves, rows))
+            if kept_sheets == set(self.sheets):
+                self._checked_at = time.monotonic()  # else the first reader syncs the sheets missing
+        self.wake()  # first thing the background thread does is to check the versions
+
+        logger.info('Loaded workflow snapshot of %d sheets, %d rows in %.1f ms', len(kept_sheets), len(rows),
+                    (time.perf_counter() - started_at) * 1000)
+        return True
+
+    @property
+    def last_snapshot(self):
+        """Latest published snapshot, never synced inline."""
+        return self._snapshot
+
+    @property
+    def seconds_since_check(self):
+        """Seconds since the sheet versions were last all checked, None before the first check."""
+        checked_at = self._checked_at
+        return None if checked_at is None else time.monotonic() - checked_at
+
+    def snapshot(self):
+        """
+        Latest published snapshot.
+        If the background thread fell behind max_staleness, sync inline first.
+        """
+        self.start()
+
+        if self._is_stale():
+            with self._sync_lock:
+                if self._is_stale():
+                    try:
+                        self._sync()
+                    except Exception:
+                        logger.exception('Inline workflow sync failed, serving stale snapshot')
+
+        return self._snapshot
+
+    def refresh(self, forced=False, wait=True):
+        """
+        Refresh now hook for write paths.
+
+        :param forced: True to download the sheets even if their version didn't change
+        :param wait: False to only wake the background thread and return immediately
+        """
+        if not wait:
+            self.wake()
+            return
+
+        with self._sync_lock:
+            self._sync(forced)
+
+    def mark_dirty(self, sheet_id, row_ids=(), sheet_changed=False):
+        """
+        Schedule a sync of some rows of a sheet, for webhook callbacks. Returns right away,
+        rows marked before the background thread gets to them are synced together.
+
+        :param sheet_id: sheet the rows belong to
+        :param row_ids: ids of rows created, updated or deleted
+        :param sheet_changed: True if the sheet itself changed (columns...), for a version check of that sheet
+        """
+        with self._dirty_lock:
+            self._dirty_row_ids.setdefault(sheet_id, set()).update(row_ids)
+            if sheet_changed:
+                self._changed_sheets.add(sheet_id)
+        self.start()
+        self.wake()
+
+    def update_move(self, row_id, **fields):
+        """
+        Apply a write just made to SS on the current snapshot,
+        so readers see it before the next sync brings it back.
+        Never waits for a running sync, the write is applied again on the snapshot that sync publishes.
+
+        :param row_id: row id of the updated move
+        :param fields: WorkflowMove fields and their new values
+        """
+        with self._publish_lock:
+            self._local_updates[row_id] = {**self._local_updates.get(row_id, {}), **fields}
+            move = self._snapshot.rows.get(row_id)
+            if move is None:
+                return
+            self._swap(self._snapshot.replace(self._snapshot.versions, new_moves=[move.replace(**fields)]))
+
+    def _is_stale(self):
+        max_staleness = 2 * self.fallback_interval if self.webhook_active else self.max_staleness
+        return self._checked_at is None or time.monotonic() - self._checked_at > max_staleness
+
+    def _interval(self):
+        return self.fallback_interval if self.webhook_active else self.interval
+
+    def _step(self):
+        self.refresh()
+
+    def _sync(self, forced=False):
+        """
+        Check which sheets were updated, and sync those.
+        Rows marked dirty are synced on their own, without checking versions, unless the sheets are due a check.
+        A sheet failing to sync doesn't keep the others from syncing.
+        """
+        with self._dirty_lock:
+            dirty_row_ids, self._dirty_row_ids = self._dirty_row_ids, {}
+            changed_sheets, self._changed_sheets = self._changed_sheets, set()
+        with self._publish_lock:
+            self._local_updates = {}  # those made before are in the snapshot the sync starts from
+
+        targeted = bool(dirty_row_ids or changed_sheets) and not forced and not self._is_stale()
+
+        failed_sheet_ids = []
+        for sheet_id in self.sheets:
+            row_ids = dirty_row_ids.get(sheet_id, set())
+            try:
+                if not targeted:
+                    self._sync_sheet(sheet_id, forced)
+                elif (sheet_id in changed_sheets or sheet_id not in self._snapshot.versions
+                      or len(row_ids) > self.max_targeted_rows):
+                    self._sync_sheet(sheet_id)
+                elif row_ids:
+                    self._targeted_sync(sheet_id, row_ids)
+            except Exception:
+                logger.exception('Sync of sheet %s failed', sheet_id)
+                failed_sheet_ids.append(sheet_id)
+                if row_ids:
+                    self.mark_dirty(sheet_id, row_ids)
+
+        with self._publish_lock:
+            self._local_updates = {}
+
+        if failed_sheet_ids:
+            raise RuntimeError(f'Sync of sheets {failed_sheet_ids} failed')
+
+        if not targeted:
+            self._checked_at = time.monotonic()
+
+    def _sync_sheet(self, sheet_id, forced=False):
+        """
+        Check if a sheet was updated.
+        If so then publish a new snapshot, built from the rows modified since the last sync when possible.
+        """
+        new_version = self.ss_client.Sheets.get_sheet_version(sheet_id).version
+
+        if not forced and self._snapshot.versions.get(sheet_id) == new_version:
+            return
+
+        if forced or not self.incremental or self._modified_since.get(sheet_id) is None:
+            self._full_sync(sheet_id, new_version)
+        else:
+            self._delta_sync(sheet_id, new_version)
+
+    def _versions(self, sheet_id, version):
+        return {**self._snapshot.versions, sheet_id: version}
+
+    def _full_sync(self, sheet_id, version):
+        col_names = self.sheets[sheet_id]
+        open_moves_log = self.ss_client.Sheets.get_sheet(sheet_id, column_ids=list(col_names))
+        check_columns(open_moves_log, col_names, sheet_id)  # a few columns, checked on every download
+
+        new_moves = [move_from_row(row, col_names, sheet_id) for row in open_moves_log.rows]
+        existing_row_ids = {move.row_id for move in new_moves}
+        deleted_row_ids = self._snapshot.sheet_row_ids(sheet_id) - existing_row_ids
+
+        self._modified_since[sheet_id] = max((row.modified_at for row in open_moves_log.rows
+                                              if row.modified_at is not None), default=None)
+        snapshot = self._snapshot.replace(self._versions(sheet_id, version), new_moves=new_moves,
+                                          dropped_row_ids=deleted_row_ids)
+        self._publish(snapshot, 'full', sheet_id, len(new_moves) + len(deleted_row_ids))
+
+    def _delta_sync(self, sheet_id, version):
+        """
+        Apply inserts, updates and deletes of a sheet on a copy of the current snapshot.
+        Rows deleted from the sheet are not reported as modified, they show up as a row count mismatch.
+        Falls back to a full sync of the sheet if its row ids still don't add up.
+        """
+        col_names = self.sheets[sheet_id]
+        modified = self.ss_client.Sheets.get_sheet(sheet_id,
+                                                   column_ids=list(col_names),
+                                                   rows_modified_since=self._modified_since[sheet_id].isoformat())
+        check_columns(modified, col_names, sheet_id)
+
+        modified_since = self._modified_since[sheet_id]
+        for row in modified.rows:
+            if row.modified_at is not None and row.modified_at > modified_since:
+                modified_since = row.modified_at
+
+        versions = self._versions(sheet_id, version)
+        new_moves = [move_from_row(row, col_names, sheet_id) for row in modified.rows]
+        snapshot = self._snapshot.replace(versions, new_moves=new_moves)
+        rows_touched = len(modified.rows)
+
+        sheet_row_ids = snapshot.sheet_row_ids(sheet_id)
+        if len(sheet_row_ids) != modified.total_row_count:
+            listing = self.ss_client.Sheets.get_sheet(sheet_id, column_ids=list(col_names)[:1])
+            existing_row_ids = {row.id for row in listing.rows}
+
+            deleted_row_ids = sheet_row_ids - existing_row_ids
+            snapshot = snapshot.replace(versions, dropped_row_ids=deleted_row_ids)
+            rows_touched += len(deleted_row_ids)
+
+            if len(sheet_row_ids) - len(deleted_row_ids) != len(existing_row_ids):
+                logger.warning('Workflow drifted from the open move log %s, running a full sync', sheet_id)
+                self._full_sync(sheet_id, version)
+                return
+
+        self._modified_since[sheet_id] = modified_since
+        self._publish(snapshot, 'delta', sheet_id, rows_touched)
+
+    def _targeted_sync(self, sheet_id, row_ids):
+        """
+        Download only the given rows of a sheet, those missing from it were deleted.
+        The sheet keeps its version, so the next version check still catches changes no callback reported.
+        """
+        col_names = self.sheets[sheet_id]
+        sheet = self.ss_client.Sheets.get_sheet(sheet_id, column_ids=list(col_names), row_ids=list(row_ids))
+        check_columns(sheet, col_names, sheet_id)
+
+        new_moves = [move_from_row(row, col_names, sheet_id) for row in sheet.rows]
+        deleted_row_ids = row_ids - {move.row_id for move in new_moves}
+        snapshot = self._snapshot.replace(self._snapshot.versions, new_moves=new_moves,
+                                          dropped_row_ids=deleted_row_ids)
+        self._publish(snapshot, 'targeted', sheet_id, len(row_ids))
+
+    def _publish(self, snapshot, mode, sheet_id, rows_touched):
+        snapshot = self._set_snapshot(snapshot)
+        self.last_sync = {'mode': mode, 'sheet_id': sheet_id, 'rows_touched': rows_touched}
+        self.rows_touched_total += rows_touched
+        logger.info('Workflow %s sync of sheet %s to version %s touched %d rows', mode, sheet_id,
+                    snapshot.versions.get(sheet_id), rows_touched)
+
+        if self.snapshot_path:
+            try:
+                self._save(snapshot)
+            except Exception:
+                logger.exception('Saving the workflow snapshot failed')
+
+    def _save(self, snapshot):
+        """Write to a temporary file then rename it, so other processes never load half a snapshot."""
+        data = (SNAPSHOT_FILE_FORMAT, self.sheets, dict(snapshot.versions), self._modified_since,
+                [_values(move) for move in snapshot.rows.values()],
+                [move.row_id for move in snapshot.moves.values()])
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.snapshot_path)), exist_ok=True)
+        temporary_path = f'{self.snapshot_path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as snapshot_file:
+            pickle.dump(data, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, self.snapshot_path)
+
+    def _set_snapshot(self, snapshot):
+        """
+        Publish a snapshot built by a sync, the downloads having happened outside of the publish lock.
+        Writes still pending, and those update_move applied in the meantime, are applied again on it,
+        so they don't flicker back.
+        """
+        overlay = {}  # {row_id: fields}
+        if self.pending_fields is not None:
+            for sheet_id in self.sheets:
+                try:
+                    overlay.update(self.pending_fields(sheet_id))
+                except Exception:
+                    logger.exception('Reading pending writes of sheet %s failed', sheet_id)
+
+        with self._publish_lock:
+            for row_id, fields in self._local_updates.items():
+                overlay[row_id] = {**overlay.get(row_id, {}), **fields}
+            new_moves = [snapshot.rows[row_id].replace(**fields) for row_id, fields in overlay.items()
+                         if row_id in snapshot.rows]
+            if new_moves:
+                snapshot = snapshot.replace(snapshot.versions, new_moves=new_moves)
+            self._swap(snapshot)
+        return snapshot
+
+    def _swap(self, snapshot):
+        previous, self._snapshot = self._snapshot, snapshot
+        if self.on_publish is not None:
+            try:
+                self.on_publish(previous, snapshot)
+            except Exception:
+                logger.exception('Workflow on_publish callback failed')